@@ -1,34 +1,99 @@
-from data_provider.data_loader import Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_Pred
+from data_provider.loader_tuning import loader_kwargs
+from data_provider.sampler import train_sampler
+from utils.registry import LazyRegistry
+import numpy as np
+import torch
 from torch.utils.data import DataLoader
 
-data_dict = {
-    'ETTh1': Dataset_ETT_hour,
-    'ETTh2': Dataset_ETT_hour,
-    'ETTm1': Dataset_ETT_minute,
-    'ETTm2': Dataset_ETT_minute,
-    'custom': Dataset_Custom,
-}
+# --data name -> dataset class; data_loader (pandas, time features) is imported on first use
+data_dict = LazyRegistry({
+    'ETTh1': 'data_provider.data_loader:Dataset_ETT_hour',
+    'ETTh2': 'data_provider.data_loader:Dataset_ETT_hour',
+    'ETTm1': 'data_provider.data_loader:Dataset_ETT_minute',
+    'ETTm2': 'data_provider.data_loader:Dataset_ETT_minute',
+    'custom': 'data_provider.data_loader:Dataset_Custom',
+    'multi': 'data_provider.data_loader:Dataset_MultiSeries',
+})
 
 
-def data_provider(args, flag):
+def eval_indices(args, data_set):
+    """
+    Windows a val/test split is evaluated on: every --eval_stride-th one, then, with
+    --eval_samples, a random subset of that many drawn with the run seed so that
+    repeated runs score the same windows. Returns (indices or None for all, the number
+    of windows the subset is drawn from).
+    """
+    index = np.arange(0, len(data_set), max(args.eval_stride, 1))
+    population = len(index)
+    if args.eval_samples and args.eval_samples < population:
+        index = np.sort(np.random.default_rng(args.random_seed).choice(index, args.eval_samples, replace=False))
+    if len(index) == len(data_set):
+        return None, population
+    return index, population
+
+
+def finetune_provider(args, scaler, start_row, train_rows=None, batch_size=None):
+    """Shuffled loader over the windows of the rows appended after start_row, see Dataset_Finetune."""
+    from data_provider.data_loader import Dataset_ETT_minute, Dataset_Finetune
+    timeenc = 0 if args.embed != 'timeF' else 1
+    data_set = Dataset_Finetune(
+        root_path=args.root_path,
+        data_path=args.data_path,
+        scaler=scaler,
+        start_row=start_row,
+        size=[args.seq_len, args.label_len, args.pred_len],
+        features=args.features,
+        target=args.target,
+        timeenc=timeenc,
+        freq=args.freq,
+        replay=args.replay,
+        seed=args.random_seed,
+        stamp_minutes=data_dict.get(args.data) is Dataset_ETT_minute,
+        train_rows=train_rows
+    )
+    print('finetune', len(data_set), '({} new, {} replayed)'.format(data_set.new_windows,
+                                                                   len(data_set) - data_set.new_windows))
+    data_loader = DataLoader(
+        data_set,
+        batch_size=batch_size or args.batch_size,
+        shuffle=True,
+        drop_last=False,
+        **loader_kwargs(args, data_set))
+    return data_set, data_loader
+
+
+def distill_provider(args, data_set, targets, batch_size=None):
+    """Shuffled loader over the windows of data_set with the teacher's forecasts, see Dataset_Distill."""
+    from data_provider.data_loader import Dataset_Distill
+    data_set = Dataset_Distill(data_set, targets)
+    data_loader = DataLoader(
+        data_set,
+        batch_size=batch_size or args.batch_size,
+        shuffle=True,
+        drop_last=True,
+        **loader_kwargs(args, data_set))
+    return data_set, data_loader
+
+
+def data_provider(args, flag, batch_size=None):
     Data = data_dict[args.data]
     timeenc = 0 if args.embed != 'timeF' else 1
 
     if flag == 'test':
         shuffle_flag = False
         drop_last = True
-        batch_size = args.batch_size
+        batch_size = batch_size or args.batch_size
         freq = args.freq
     elif flag == 'pred':
         shuffle_flag = False
         drop_last = False
         batch_size = 1
         freq = args.freq
-        Data = Dataset_Pred
+        from data_provider.data_loader import Dataset_Pred as Data
     else:
         shuffle_flag = True
         drop_last = True
-        batch_size = args.batch_size
+        batch_size = batch_size or args.batch_size
         freq = args.freq
 
     data_set = Data(
@@ -41,11 +106,38 @@ def data_provider(args, flag):
         timeenc=timeenc,
         freq=freq
     )
-    print(flag, len(data_set))
+    if flag == 'train' and args.sample_channels:
+        from data_provider.data_loader import Dataset_ChannelSampled
+        data_set = Dataset_ChannelSampled(data_set, args.sample_channels, seed=args.random_seed)
+        print('training on {} channels of {} per window'.format(data_set.channels, data_set.n_channels))
+    data_set.eval_index, data_set.eval_population = None, len(data_set)
+    sampler = None
+    if flag in ['val', 'test']:
+        data_set.eval_index, data_set.eval_population = eval_indices(args, data_set)
+    if data_set.eval_index is not None:
+        print(flag, len(data_set), '(evaluating {} windows)'.format(len(data_set.eval_index)))
+        # the subset is already small, keep every window of it
+        sampler = data_set.eval_index
+        shuffle_flag = False
+        drop_last = False
+    elif flag == 'train':
+        # also the plain shuffle (block_size 1), its order then depends only on the seed and
+        # the epoch: train() sets the epoch, a resumed run sees the same batches. The seed is
+        # drawn from the global RNG, which run.py seeds once, so every --itr replica gets its own order
+        sampler = train_sampler(args, len(data_set), seed=int(torch.randint(2 ** 31, ())))
+        if args.epoch_samples or args.shuffle_block > 1:
+            print(flag, len(data_set), '({} windows per epoch, shuffled in blocks of {})'.format(
+                len(sampler), sampler.block_size))
+        else:
+            print(flag, len(data_set))
+        shuffle_flag = False
+    else:
+        print(flag, len(data_set))
     data_loader = DataLoader(
         data_set,
         batch_size=batch_size,
         shuffle=shuffle_flag,
-        num_workers=args.num_workers,
-        drop_last=drop_last)
+        sampler=sampler,
+        drop_last=drop_last,
+        **loader_kwargs(args, data_set))
     return data_set, data_loader
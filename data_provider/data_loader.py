@@ -1,15 +1,75 @@
+import glob
 import os
 import numpy as np
 import pandas as pd
-import os
 import torch
 from torch.utils.data import Dataset, DataLoader
-from sklearn.preprocessing import StandardScaler
 from utils.timefeatures import time_features
+from utils.tools import StandardScaler
 import warnings
 
 warnings.filterwarnings('ignore')
 
+# raw csv frames kept by preload_raw_data(), so that repeated runs in one
+# process (or forked from it) skip re-parsing the file
+_raw_data_cache = {}
+
+
+def preload_raw_data(root_path, data_path):
+    key = os.path.join(root_path, data_path)
+    if key not in _raw_data_cache:
+        _raw_data_cache[key] = pd.read_csv(key)
+    return _raw_data_cache[key]
+
+
+# per-series lengths, train-split stats and parsed arrays of a Dataset_MultiSeries file set,
+# shared by its train/val/test datasets so every file is parsed once
+_series_index_cache = {}
+
+
+def read_raw_data(root_path, data_path):
+    key = os.path.join(root_path, data_path)
+    if key in _raw_data_cache:
+        return _raw_data_cache[key]
+    return pd.read_csv(key)
+
+
+def read_series(root_path, data_path, scaler, features='S', target='OT', timeenc=0, freq='h', stamp_minutes=False):
+    """
+    The whole file as one series, no splits and no windows: (data scaled with the fitted
+    `scaler`, time features, dates), one row per row of the file. Columns are in the
+    order of Dataset_Custom, for the ETT files that is the file's order.
+    """
+    df_raw = read_raw_data(root_path, data_path)
+    cols = list(df_raw.columns)
+    cols.remove(target)
+    cols.remove('date')
+    df_raw = df_raw[['date'] + cols + [target]]
+
+    if features == 'M' or features == 'MS':
+        df_data = df_raw[df_raw.columns[1:]]
+    elif features == 'S':
+        df_data = df_raw[[target]]
+    data = scaler.transform(df_data.values)
+
+    dates = pd.to_datetime(df_raw['date'])
+    return data, date_stamps(dates, timeenc, freq, stamp_minutes), dates
+
+
+def date_stamps(dates, timeenc=0, freq='h', minutes=False):
+    """
+    Time features of a date column, [rows, features], as the datasets build them: with
+    timeenc 0 month, day, weekday, hour (and with `minutes` the quarter hour, as
+    Dataset_ETT_minute), with timeenc 1 time_features at freq.
+    """
+    dates = pd.to_datetime(pd.Series(dates))
+    if timeenc == 0:
+        fields = [dates.dt.month, dates.dt.day, dates.dt.weekday, dates.dt.hour]
+        if minutes:
+            fields.append(dates.dt.minute // 15)
+        return np.stack([f.values for f in fields], axis=1).astype(np.int64)
+    return time_features(pd.to_datetime(dates.values), freq=freq).transpose(1, 0)
+
 
 class Dataset_ETT_hour(Dataset):
     def __init__(self, root_path, flag='train', size=None,
@@ -42,13 +102,15 @@ class Dataset_ETT_hour(Dataset):
 
     def __read_data__(self):
         self.scaler = StandardScaler()
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
+        df_raw = read_raw_data(self.root_path, self.data_path)
+        self.n_rows = len(df_raw)
 
         border1s = [0, 12 * 30 * 24 - self.seq_len, 12 * 30 * 24 + 4 * 30 * 24 - self.seq_len]
         border2s = [12 * 30 * 24, 12 * 30 * 24 + 4 * 30 * 24, 12 * 30 * 24 + 8 * 30 * 24]
         border1 = border1s[self.set_type]
         border2 = border2s[self.set_type]
+        # the rows training sees, a fine-tune may replay windows from these only (Dataset_Finetune)
+        self.train_rows = border2s[0]
 
         if self.features == 'M' or self.features == 'MS':
             cols_data = df_raw.columns[1:]
@@ -130,13 +192,15 @@ class Dataset_ETT_minute(Dataset):
 
     def __read_data__(self):
         self.scaler = StandardScaler()
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
+        df_raw = read_raw_data(self.root_path, self.data_path)
+        self.n_rows = len(df_raw)
 
         border1s = [0, 12 * 30 * 24 * 4 - self.seq_len, 12 * 30 * 24 * 4 + 4 * 30 * 24 * 4 - self.seq_len]
         border2s = [12 * 30 * 24 * 4, 12 * 30 * 24 * 4 + 4 * 30 * 24 * 4, 12 * 30 * 24 * 4 + 8 * 30 * 24 * 4]
         border1 = border1s[self.set_type]
         border2 = border2s[self.set_type]
+        # the rows training sees, a fine-tune may replay windows from these only (Dataset_Finetune)
+        self.train_rows = border2s[0]
 
         if self.features == 'M' or self.features == 'MS':
             cols_data = df_raw.columns[1:]
@@ -220,8 +284,8 @@ class Dataset_Custom(Dataset):
 
     def __read_data__(self):
         self.scaler = StandardScaler()
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
+        df_raw = read_raw_data(self.root_path, self.data_path)
+        self.n_rows = len(df_raw)
 
         '''
         df_raw.columns: ['date', ...(other features), target feature]
@@ -238,6 +302,8 @@ class Dataset_Custom(Dataset):
         border2s = [num_train, num_train + num_vali, len(df_raw)]
         border1 = border1s[self.set_type]
         border2 = border2s[self.set_type]
+        # the rows training sees, a fine-tune may replay windows from these only (Dataset_Finetune)
+        self.train_rows = border2s[0]
 
         if self.features == 'M' or self.features == 'MS':
             cols_data = df_raw.columns[1:]
@@ -290,6 +356,260 @@ class Dataset_Custom(Dataset):
         return self.scaler.inverse_transform(data)
     
 
+class Dataset_MultiSeries(Dataset):
+    """
+    Windows over many independent series, one csv per series, for training one global model.
+
+    data_path is a glob pattern under root_path (e.g. 'series/*.csv'); every file has the
+    layout of Dataset_Custom and is split 0.7/0.1/0.2 on its own, with its own scaler
+    statistics fit on its train part. Windows never cross from one series into another:
+    window_offsets[i] is the index of the first window of series i, the series of a
+    window is found by binary search, so the index is one int64 per series.
+
+    Every file is parsed once, into one array of all series end to end (row_offsets[i]
+    is the first row of series i) and their time features, built like those of the
+    single-series datasets (date_stamps). Train, val and test share the arrays.
+    Windows of one series have consecutive indices, so --shuffle_block keeps the
+    reads of a training epoch local.
+    """
+
+    def __init__(self, root_path, flag='train', size=None,
+                 features='S', data_path='*.csv',
+                 target='OT', scale=True, timeenc=0, freq='h'):
+        # size [seq_len, label_len, pred_len]
+        self.seq_len, self.label_len, self.pred_len = size
+        assert flag in ['train', 'test', 'val']
+        type_map = {'train': 0, 'val': 1, 'test': 2}
+        self.set_type = type_map[flag]
+
+        self.features = features
+        self.target = target
+        self.scale = scale
+        self.timeenc = timeenc
+        self.freq = freq
+        # one scaler per series, see series_mean / series_std
+        self.scaler = None
+
+        self.root_path = root_path
+        self.data_path = data_path
+        self.__read_data__()
+
+    def _columns(self, path):
+        cols = list(pd.read_csv(path, nrows=0).columns)
+        cols.remove(self.target)
+        cols.remove('date')
+        if self.features == 'S':
+            return []
+        return cols
+
+    def _borders(self, length):
+        num_train = int(length * 0.7)
+        num_test = int(length * 0.2)
+        num_vali = length - num_train - num_test
+        border1s = [0, num_train - self.seq_len, length - num_test - self.seq_len]
+        border2s = [num_train, num_train + num_vali, length]
+        return border1s, border2s
+
+    def __read_data__(self):
+        key = (os.path.join(self.root_path, self.data_path), self.features, self.target,
+               self.scale, self.timeenc, self.freq)
+        if key not in _series_index_cache:
+            files = sorted(glob.glob(key[0]))
+            if not files:
+                raise FileNotFoundError('no series files match {}'.format(key[0]))
+            cols = self._columns(files[0])
+            lengths, means, stds, series, stamps = [], [], [], [], []
+            for path in files:
+                df_raw = pd.read_csv(path, usecols=['date'] + cols + [self.target])
+                values = df_raw[cols + [self.target]].values
+                border1s, border2s = self._borders(len(values))
+                scaler = StandardScaler().fit(values[border1s[0]:border2s[0]])
+                lengths.append(len(values))
+                means.append(scaler.mean.numpy())
+                stds.append(scaler.std.numpy())
+                series.append((values - means[-1]) / stds[-1] if self.scale else values)
+                # the quarter-hour field of Dataset_ETT_minute at minute frequency, as in Dataset_Pred
+                stamps.append(date_stamps(df_raw['date'], self.timeenc, self.freq, minutes=self.freq == 't'))
+            _series_index_cache[key] = (files, cols, np.array(lengths, dtype=np.int64), np.array(means),
+                                        np.array(stds), np.concatenate(series), np.concatenate(stamps))
+        (self.files, self.cols, self.lengths, self.series_mean, self.series_std,
+         self.data, self.data_stamp) = _series_index_cache[key]
+        self.row_offsets = np.concatenate([[0], np.cumsum(self.lengths)[:-1]])
+        self.n_rows = int(self.lengths.sum())
+        self.train_rows = int(sum(self._borders(int(length))[1][0] for length in self.lengths))
+
+        self.border1 = np.empty(len(self.files), dtype=np.int64)
+        num_windows = np.empty(len(self.files), dtype=np.int64)
+        for i, length in enumerate(self.lengths):
+            border1s, border2s = self._borders(int(length))
+            self.border1[i] = max(border1s[self.set_type], 0)
+            num_windows[i] = max(border2s[self.set_type] - self.border1[i] - self.seq_len - self.pred_len + 1, 0)
+        self.window_offsets = np.concatenate([[0], np.cumsum(num_windows)])
+
+    def __getitem__(self, index):
+        series = int(np.searchsorted(self.window_offsets, index, side='right')) - 1
+        s_begin = self.row_offsets[series] + self.border1[series] + index - self.window_offsets[series]
+        s_end = s_begin + self.seq_len
+        r_begin = s_end - self.label_len
+        r_end = r_begin + self.label_len + self.pred_len
+
+        seq_x = self.data[s_begin:s_end]
+        seq_y = self.data[r_begin:r_end]
+        seq_x_mark = self.data_stamp[s_begin:s_end]
+        seq_y_mark = self.data_stamp[r_begin:r_end]
+
+        return seq_x, seq_y, seq_x_mark, seq_y_mark
+
+    def __len__(self):
+        return int(self.window_offsets[-1])
+
+    def inverse_transform(self, data, series):
+        return data * self.series_std[series] + self.series_mean[series]
+
+
+class Dataset_ChannelSampled(Dataset):
+    """
+    (window, channel subset) pairs of a dataset, for channel-independent models on wide data.
+
+    Every window of `data_set` is paired with each of ceil(C / channels) groups of
+    `channels` channel ids, a fresh random partition per window and epoch (the last group
+    wraps around to stay full), so batch memory depends on `channels`, not on C.
+    Items are the window's arrays restricted to the group, plus the group's channel ids.
+    Pairs of one window have consecutive indices. Other attributes are the wrapped dataset's.
+    """
+
+    def __init__(self, data_set, channels, seed=0):
+        self.data_set = data_set
+        self.n_channels = np.asarray(data_set.data_x).shape[-1] if hasattr(data_set, 'data_x') \
+            else len(data_set[0][0][0])
+        self.channels = min(channels, self.n_channels)
+        self.groups = -(-self.n_channels // self.channels)
+        self.seed = seed
+        self.epoch = 0
+
+    def __getattr__(self, name):
+        if name == 'data_set':
+            raise AttributeError(name)
+        return getattr(self.data_set, name)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __getitem__(self, index):
+        window, group = divmod(index, self.groups)
+        seq_x, seq_y, seq_x_mark, seq_y_mark = self.data_set[window]
+        order = np.random.default_rng([self.seed, self.epoch, window]).permutation(self.n_channels)
+        ids = order[(group * self.channels + np.arange(self.channels)) % self.n_channels]
+        return seq_x[:, ids], seq_y[:, ids], seq_x_mark, seq_y_mark, ids
+
+    def __len__(self):
+        return len(self.data_set) * self.groups
+
+
+class Dataset_Distill(Dataset):
+    """
+    Windows of a dataset paired with a teacher's forecast of them, for distillation.
+    `targets` holds one [pred_len, C] forecast per window of `data_set`, in window order
+    (a memory-mapped array is fine). Other attributes are the wrapped dataset's.
+    """
+
+    def __init__(self, data_set, targets):
+        if len(targets) != len(data_set):
+            raise ValueError('{} teacher forecasts for {} windows'.format(len(targets), len(data_set)))
+        self.data_set = data_set
+        self.targets = targets
+
+    def __getattr__(self, name):
+        if name == 'data_set':
+            raise AttributeError(name)
+        return getattr(self.data_set, name)
+
+    def __getitem__(self, index):
+        seq_x, seq_y, seq_x_mark, seq_y_mark = self.data_set[index]
+        return seq_x, seq_y, seq_x_mark, seq_y_mark, np.asarray(self.targets[index], dtype=np.float32)
+
+    def __len__(self):
+        return len(self.data_set)
+
+
+class Dataset_Finetune(Dataset):
+    """
+    Windows for warm-starting a trained model on rows appended to the file since it was fit.
+
+    The rows from `start_row` on are new (a negative value counts from the end). Every window
+    forecasts into the new rows, its input reaching back at most seq_len rows into the old
+    ones. `replay` adds that many old windows per new window, drawn once with `seed` from
+    the windows lying entirely in the first `train_rows` rows, the ones the checkpoint was
+    trained on (not its val/test rows); a chain of fine-tunes keeps that bound. The data is
+    scaled with `scaler`, the fitted scaler the checkpoint was trained under, it is not refit.
+    """
+
+    def __init__(self, root_path, scaler, start_row, flag='finetune', size=None,
+                 features='S', data_path='ETTh1.csv', target='OT', timeenc=0, freq='h',
+                 replay=0., seed=0, stamp_minutes=False, train_rows=None):
+        # size [seq_len, label_len, pred_len]
+        self.seq_len, self.label_len, self.pred_len = size
+        assert flag in ['finetune']
+
+        self.scaler = scaler
+        self.start_row = start_row
+        self.features = features
+        self.target = target
+        self.timeenc = timeenc
+        self.freq = freq
+        self.replay = replay
+        self.seed = seed
+        self.stamp_minutes = stamp_minutes
+        self.train_rows = train_rows
+
+        self.root_path = root_path
+        self.data_path = data_path
+        self.__read_data__()
+
+    def __read_data__(self):
+        data, data_stamp, _ = read_series(self.root_path, self.data_path, self.scaler, self.features, self.target,
+                                          self.timeenc, self.freq, self.stamp_minutes)
+        self.n_rows = len(data)
+
+        start = self.start_row if self.start_row >= 0 else self.n_rows + self.start_row
+        last = self.n_rows - self.seq_len - self.pred_len
+        new_windows = np.arange(max(start - self.seq_len, 0), last + 1)
+        if not len(new_windows) or start >= self.n_rows:
+            raise ValueError('{} has {} rows, none after row {} to fine-tune on'.format(
+                self.data_path, self.n_rows, start))
+        if self.train_rows is None:
+            self.train_rows = start
+        old_rows = min(start, self.train_rows)
+        old_windows = np.arange(0, max(old_rows - self.seq_len - self.pred_len + 1, 0))
+        n_replay = min(int(round(self.replay * len(new_windows))), len(old_windows))
+        replayed = np.random.default_rng(self.seed).choice(old_windows, n_replay, replace=False)
+        self.new_windows = len(new_windows)
+        self.index = np.concatenate([np.sort(replayed), new_windows])
+
+        self.data_x = data
+        self.data_y = data
+        self.data_stamp = data_stamp
+
+    def __getitem__(self, index):
+        s_begin = self.index[index]
+        s_end = s_begin + self.seq_len
+        r_begin = s_end - self.label_len
+        r_end = r_begin + self.label_len + self.pred_len
+
+        seq_x = self.data_x[s_begin:s_end]
+        seq_y = self.data_y[r_begin:r_end]
+        seq_x_mark = self.data_stamp[s_begin:s_end]
+        seq_y_mark = self.data_stamp[r_begin:r_end]
+
+        return seq_x, seq_y, seq_x_mark, seq_y_mark
+
+    def __len__(self):
+        return len(self.index)
+
+    def inverse_transform(self, data):
+        return self.scaler.inverse_transform(data)
+
+
 class Dataset_Pred(Dataset):
     def __init__(self, root_path, flag='pred', size=None,
                  features='S', data_path='ETTh1.csv',
@@ -320,8 +640,8 @@ class Dataset_Pred(Dataset):
 
     def __read_data__(self):
         self.scaler = StandardScaler()
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
+        df_raw = read_raw_data(self.root_path, self.data_path)
+        self.n_rows = len(df_raw)
         '''
         df_raw.columns: ['date', ...(other features), target feature]
         '''
@@ -0,0 +1,81 @@
+import os
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+from data_provider.sampler import train_sampler
+from utils.placement import loader_worker_init
+
+
+def loader_kwargs(args, data_set, num_workers=None, prefetch_factor=None):
+    """
+    DataLoader worker arguments of a run. Workers are persistent, so they are started once
+    per loader instead of every epoch and every evaluation pass, except for datasets that
+    change between epochs (set_epoch, e.g. Dataset_ChannelSampled): persistent workers
+    would keep their epoch-0 copy. Batches are pinned when they go to a GPU, and workers
+    are pinned to --loader_cores when given (utils.placement).
+
+    Every loader draws its worker seeds (and a shuffle=True order) from its own generator,
+    seeded with the run seed, never from the global RNG: a fresh iterator draws a worker
+    seed and a persistent one does not, which would shift the dropout masks of a resumed
+    run against the uninterrupted one.
+    """
+    num_workers = args.num_workers if num_workers is None else num_workers
+    kwargs = {'num_workers': num_workers, 'pin_memory': bool(args.use_gpu),
+              'generator': torch.Generator().manual_seed(args.random_seed)}
+    if num_workers > 0:
+        kwargs['persistent_workers'] = not hasattr(data_set, 'set_epoch')
+        kwargs['prefetch_factor'] = prefetch_factor or args.prefetch_factor
+        kwargs['worker_init_fn'] = loader_worker_init(args)
+    return kwargs
+
+
+def batch_time(args, data_set, batch_size, num_workers, prefetch_factor, batches=20):
+    """Seconds per batch of the training loader, after its first batch (i.e. without worker startup)."""
+    loader = DataLoader(data_set, batch_size=batch_size, sampler=train_sampler(args, len(data_set)), drop_last=True,
+                        **dict(loader_kwargs(args, data_set, num_workers, prefetch_factor), persistent_workers=False))
+    it = iter(loader)
+    next(it)
+    n = 0
+    start = time.perf_counter()
+    for _ in it:
+        n += 1
+        if n == batches:
+            break
+    elapsed = time.perf_counter() - start
+    del it
+    return elapsed / max(n, 1)
+
+
+def tune_loader(args, data_set, step_time, batch_size=None, batches=20, slack=1.1):
+    """
+    Pick (num_workers, prefetch_factor) for training on data_set, given the model's time
+    per training step in seconds.
+
+    Every candidate loader is timed over `batches` batches. The loader only has to keep up
+    with the model, so the pick is the fewest workers (then the shallowest prefetch) whose
+    batch time is within `slack` of max(step_time, fastest batch time): workers beyond
+    that only take cores from the model's own threads.
+    """
+    batch_size = batch_size or args.batch_size
+    n_batches = len(train_sampler(args, len(data_set))) // batch_size
+    if n_batches < 2:
+        # the first batch of a candidate is not timed, there would be nothing to time
+        print('loader tuning skipped: {} training batches per epoch'.format(n_batches))
+        return args.num_workers, None
+    batches = max(1, min(batches, n_batches - 1))
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    workers = [0] + [w for w in (1, 2, 4, 8, 16, 32) if w <= max(cores, 2)]
+    timings = {}
+    for w in workers:
+        for prefetch in ([None] if w == 0 else [2, 4]):
+            timings[(w, prefetch)] = batch_time(args, data_set, batch_size, w, prefetch, batches)
+    target = max(step_time, min(timings.values())) * slack
+    choice = next(config for config in timings if timings[config] <= target)
+
+    print('loader tuning ({} cores, model step {:.1f} ms/batch):'.format(cores, step_time * 1000))
+    for (w, prefetch), t in timings.items():
+        print('\t{} workers, prefetch {}: {:.1f} ms/batch{}'.format(
+            w, prefetch or '-', t * 1000, '  <- chosen' if (w, prefetch) == choice else ''))
+    return choice
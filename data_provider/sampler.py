@@ -0,0 +1,55 @@
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class BlockShuffleSampler(Sampler):
+    """
+    Draws num_samples training windows per epoch while keeping reads local.
+
+    The window indices are cut into contiguous blocks of block_size windows and the
+    blocks are visited in random order. Windows of buffer_blocks consecutive visited
+    blocks are shuffled together, so a batch mixes several distant parts of the series
+    while the reads at any time stay inside a few block-sized regions of the data
+    (friendly to the page cache when the data is memory-mapped). An epoch ends after
+    num_samples windows, i.e. after roughly num_samples / block_size whole blocks.
+    With block_size 1 this is a plain random subset.
+
+    The order depends only on seed and the epoch, set_epoch() is called by train()
+    so that a resumed run sees the same windows; otherwise every iteration moves on
+    to the next epoch.
+    """
+
+    def __init__(self, n, num_samples=0, block_size=1, buffer_blocks=8, seed=0):
+        self.n = n
+        self.num_samples = min(num_samples, n) if num_samples else n
+        self.block_size = max(block_size, 1)
+        self.buffer_blocks = max(buffer_blocks, 1)
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        self.epoch += 1
+        n_blocks = -(-self.n // self.block_size)
+        order = rng.permutation(n_blocks)
+        remaining = self.num_samples
+        for start in range(0, n_blocks, self.buffer_blocks):
+            if remaining <= 0:
+                return
+            group = np.concatenate([np.arange(b * self.block_size, min((b + 1) * self.block_size, self.n))
+                                    for b in order[start:start + self.buffer_blocks]])
+            group = rng.permutation(group)[:remaining]
+            remaining -= len(group)
+            yield from group.tolist()
+
+    def __len__(self):
+        return self.num_samples
+
+
+def train_sampler(args, n, seed=None):
+    """The sampler of a run's training loader, see data_factory.data_provider; seed defaults to --random_seed."""
+    return BlockShuffleSampler(n, args.epoch_samples, args.shuffle_block, args.shuffle_buffer,
+                               seed=args.random_seed if seed is None else seed)
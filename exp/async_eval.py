@@ -0,0 +1,82 @@
+import copy
+import multiprocessing as mp
+import traceback
+
+import torch
+
+from utils.tools import cpu_snapshot
+
+
+def _eval_worker(args, model, tasks, results):
+    try:
+        if args.eval_threads:
+            torch.set_num_threads(args.eval_threads)
+        from exp.exp_main import Exp_Main
+        exp = Exp_Main(args)
+        # the trainer's architecture, which may differ from what args build (e.g. a pruned model)
+        exp.model = model.to(exp.device)
+        vali_data, vali_loader = exp._get_data(flag='val')
+        test_data, test_loader = exp._get_data(flag='test')
+        criterion = exp._select_criterion()
+    except Exception:
+        results.put(traceback.format_exc())
+        return
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        epoch, state_dict = task
+        try:
+            exp.model.load_state_dict(state_dict)
+            vali_loss = exp.vali(vali_data, vali_loader, criterion)
+            test_loss = exp.vali(test_data, test_loader, criterion)
+            results.put((epoch, vali_loss, test_loss))
+        except Exception:
+            results.put(traceback.format_exc())
+
+
+class AsyncEvaluator:
+    """
+    Runs Exp_Main.vali on the val and test sets in a separate process.
+
+    submit() hands over a CPU snapshot of the weights and returns at once; collect()
+    blocks for the oldest submitted epoch and returns (epoch, snapshot, vali_loss, test_loss),
+    the snapshot being what EarlyStopping should save if the epoch turns out best.
+    `pending` holds the submitted snapshots not yet collected, by epoch.
+    The worker gets a cpu copy of the trainer's model, so any architecture the trainer
+    ends up with is evaluated as is, and builds its own datasets from args; it is started
+    with 'spawn' so it does not inherit the trainer's thread pools or cuda context.
+    """
+
+    def __init__(self, args, model):
+        ctx = mp.get_context('spawn')
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.pending = {}
+        model = copy.deepcopy(model).cpu()
+        self.process = ctx.Process(target=_eval_worker, args=(args, model, self.tasks, self.results), daemon=True)
+        self.process.start()
+
+    def submit(self, epoch, model):
+        self.submit_snapshot(epoch, cpu_snapshot(model.state_dict()))
+
+    def submit_snapshot(self, epoch, snapshot):
+        # also how a resumed run hands over the snapshots its checkpoint had pending
+        self.pending[epoch] = snapshot
+        self.tasks.put((epoch, snapshot))
+
+    def collect(self):
+        if not self.pending:
+            return None
+        result = self.results.get()
+        if isinstance(result, str):
+            self.close()
+            raise RuntimeError('asynchronous evaluation failed:\n' + result)
+        epoch, vali_loss, test_loss = result
+        return epoch, self.pending.pop(epoch), vali_loss, test_loss
+
+    def close(self):
+        if self.process.is_alive():
+            self.tasks.put(None)
+            self.process.join()
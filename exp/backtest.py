@@ -0,0 +1,182 @@
+"""
+Rolling-origin backtest of a trained checkpoint.
+
+    python -m exp.backtest --model PatchMixer --seq_len 336 --pred_len 96 --origins 12000:17000:24
+    python -m exp.backtest ... --origins 12000:17000:24 --refit_every 30 --out backtest.csv
+
+An origin t forecasts rows [t, t + pred_len) from rows [t - seq_len, t) of the whole
+file. All origin windows are cut from the scaled series with one strided gather and
+forecast in large batches. With --refit_every k the model is fine-tuned, before every
+k-th origin, on the windows that became fully observed since the previous refit.
+Arguments not listed below are passed on to the run.py parser.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from data_provider.data_factory import data_dict
+from data_provider.data_loader import Dataset_ETT_minute, read_series
+from exp.exp_main import Exp_Main
+from run import build_parser, finalize_args, get_setting
+from utils.metrics import METRIC_NAMES, metric, metric_per_window
+from utils.tools import StandardScaler
+
+
+def parse_origins(value):
+    """'start:stop:step' (stop exclusive) or a comma separated list of row indices."""
+    if ':' in value:
+        start, stop, step = (int(v) if v else None for v in (value.split(':') + [''])[:3])
+        return np.arange(start, stop, step or 1)
+    return np.array([int(v) for v in value.split(',') if v])
+
+
+class Backtester:
+    """
+    Holds the whole scaled series of args.data_path on the device and forecasts any set
+    of origins of it with exp's model.
+    """
+
+    def __init__(self, exp, scaler):
+        self.exp = exp
+        self.args = args = exp.args
+        data, data_stamp, self.dates = read_series(
+            args.root_path, args.data_path, scaler,
+            features=args.features,
+            target=args.target,
+            timeenc=0 if args.embed != 'timeF' else 1,
+            freq=args.freq,
+            stamp_minutes=data_dict.get(args.data) is Dataset_ETT_minute
+        )
+        self.n_rows = len(data)
+        device = exp.device
+        self.data = torch.as_tensor(np.asarray(data), dtype=torch.float32).to(device)
+        self.stamp = torch.as_tensor(np.asarray(data_stamp, dtype=np.float32)).to(device)
+
+    def windows(self, origins):
+        """(x, y, x_mark, y_mark) of every origin, gathered at once from unfold views of the series."""
+        seq_len, label_len, pred_len = self.args.seq_len, self.args.label_len, self.args.pred_len
+        index = torch.as_tensor(origins, device=self.data.device)
+        # unfold(0, size, 1) -> [num_windows, D, size], window i starting at row i
+        x = self.data.unfold(0, seq_len, 1)[index - seq_len].permute(0, 2, 1)
+        y = self.data.unfold(0, label_len + pred_len, 1)[index - label_len].permute(0, 2, 1)
+        x_mark = self.stamp.unfold(0, seq_len, 1)[index - seq_len].permute(0, 2, 1)
+        y_mark = self.stamp.unfold(0, label_len + pred_len, 1)[index - label_len].permute(0, 2, 1)
+        return x, y, x_mark, y_mark
+
+    def forecast(self, origins, batch_size):
+        """Forecasts and targets of the origins, [len(origins), pred_len, D] numpy arrays each."""
+        x, y, x_mark, y_mark = self.windows(origins)
+        f_dim = -1 if self.args.features == 'MS' else 0
+        preds = []
+        self.exp.model.eval()
+        with torch.no_grad():
+            for start in range(0, len(origins), batch_size):
+                batch_y = y[start:start + batch_size]
+                dec_inp = torch.zeros_like(batch_y[:, -self.args.pred_len:, :])
+                dec_inp = torch.cat([batch_y[:, :self.args.label_len, :], dec_inp], dim=1)
+                outputs = self.exp.forecast(x[start:start + batch_size].contiguous(),
+                                            x_mark[start:start + batch_size].contiguous(), dec_inp,
+                                            y_mark[start:start + batch_size].contiguous())
+                preds.append(outputs[:, -self.args.pred_len:, f_dim:].float().cpu().numpy())
+        trues = y[:, -self.args.pred_len:, f_dim:].cpu().numpy()
+        return np.concatenate(preds), trues
+
+    def refit(self, first_row, last_row, epochs, batch_size):
+        """
+        Fine-tune on every window that is fully observed at origin last_row but was not yet at
+        origin first_row, i.e. whose target ends in rows (first_row, last_row]; its input and
+        the start of its target may lie before first_row.
+        """
+        pred_len = self.args.pred_len
+        origins = np.arange(max(first_row - pred_len + 1, self.args.seq_len), last_row - pred_len + 1)
+        if not len(origins):
+            return 0
+        x, y, x_mark, y_mark = self.windows(origins)
+        model_optim = self.exp._select_optimizer()
+        criterion = self.exp._select_criterion()
+        f_dim = -1 if self.args.features == 'MS' else 0
+        self.exp.model.train()
+        for _ in range(epochs):
+            for index in torch.randperm(len(origins), device=x.device).split(batch_size):
+                batch_y = y[index]
+                dec_inp = torch.zeros_like(batch_y[:, -self.args.pred_len:, :])
+                dec_inp = torch.cat([batch_y[:, :self.args.label_len, :], dec_inp], dim=1)
+                model_optim.zero_grad()
+                outputs = self.exp.model(x[index], x_mark[index], dec_inp, y_mark[index])
+                loss = criterion(outputs[:, -self.args.pred_len:, f_dim:], batch_y[:, -self.args.pred_len:, f_dim:])
+                loss.backward()
+                model_optim.step()
+        return len(origins)
+
+    def run(self, origins, refit_every=0, refit_epochs=1, batch_size=1024):
+        """Per-origin metric rows and the metrics over all origins together."""
+        origins = np.asarray(origins)
+        bad = (origins < self.args.seq_len) | (origins + self.args.pred_len > self.n_rows)
+        if bad.any():
+            raise ValueError('origins need {} rows of history and {} rows of future, {} of {} do not fit'.format(
+                self.args.seq_len, self.args.pred_len, int(bad.sum()), len(origins)))
+        blocks = [origins] if not refit_every else np.split(origins, range(refit_every, len(origins), refit_every))
+        preds, trues = [], []
+        refit_from = None
+        for block in blocks:
+            if refit_every and refit_from is not None:
+                # only what is observed before the block's first origin
+                n = self.refit(refit_from, int(block[0]), refit_epochs, batch_size)
+                print('refit on {} windows before origin {}'.format(n, int(block[0])))
+            pred, true = self.forecast(block, batch_size)
+            preds.append(pred)
+            trues.append(true)
+            refit_from = int(block[0])
+        preds = np.concatenate(preds)
+        trues = np.concatenate(trues)
+
+        per_origin = pd.DataFrame({'origin': origins.astype(int), 'date': self.dates.iloc[origins].map(str).values})
+        for name, values in zip(METRIC_NAMES, metric_per_window(preds, trues)):
+            per_origin[name] = values
+        overall = dict(zip(METRIC_NAMES, (float(np.mean(m)) for m in metric(preds, trues))))
+        return per_origin, overall, preds
+
+
+def load_checkpoint(exp, checkpoint_dir):
+    """Weights and the scaler they were trained under; older checkpoints refit the scaler on the train split."""
+    exp.model.load_state_dict(torch.load(os.path.join(checkpoint_dir, 'checkpoint.pth'), map_location=exp.device))
+    scaler_path = os.path.join(checkpoint_dir, 'scaler.pth')
+    if os.path.exists(scaler_path):
+        scaler = StandardScaler()
+        scaler.load_state_dict(torch.load(scaler_path))
+        return scaler
+    return exp._get_data(flag='train')[0].scaler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rolling-origin backtest of a trained checkpoint',
+                                     epilog='all other arguments are passed on to run.py')
+    parser.add_argument('--origins', type=parse_origins, required=True,
+                        help='forecast origins as row indices, start:stop:step or a comma separated list')
+    parser.add_argument('--checkpoint_dir', type=str, default='',
+                        help='directory of checkpoint.pth, default: the run.py setting under --checkpoints')
+    parser.add_argument('--refit_every', type=int, default=0, help='fine-tune before every n-th origin, 0: never')
+    parser.add_argument('--refit_epochs', type=int, default=1)
+    parser.add_argument('--backtest_batch_size', type=int, default=1024)
+    parser.add_argument('--out', type=str, default='', help='write the per-origin metrics as csv')
+    bt_args, run_argv = parser.parse_known_args()
+
+    args = finalize_args(build_parser().parse_args(run_argv))
+    torch.manual_seed(args.random_seed)
+    exp = Exp_Main(args)
+    checkpoint_dir = bt_args.checkpoint_dir or os.path.join(args.checkpoints, get_setting(args, 0))
+    backtester = Backtester(exp, load_checkpoint(exp, checkpoint_dir))
+
+    start = time.time()
+    per_origin, overall, _ = backtester.run(bt_args.origins, bt_args.refit_every, bt_args.refit_epochs,
+                                            bt_args.backtest_batch_size)
+    print('{} origins in {:.2f}s'.format(len(per_origin), time.time() - start))
+    print(per_origin[['origin', 'date', 'mse', 'mae']].describe().loc[['mean', 'std', 'min', 'max']].to_string())
+    print('overall ' + ', '.join('{}:{:.6f}'.format(k, overall[k]) for k in ('mse', 'mae', 'rse')))
+    if bt_args.out:
+        per_origin.to_csv(bt_args.out, index=False)
+        print('per-origin metrics written to {}'.format(bt_args.out))
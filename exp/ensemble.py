@@ -0,0 +1,165 @@
+"""
+Ensemble of the K checkpoints of one setting trained with different seeds (--itr K).
+
+    python -m exp.ensemble --model PatchMixer --seq_len 336 --pred_len 96 --itr 5 --quantiles 0.1,0.5,0.9
+
+The members' parameters are stacked (torch.func.stack_module_state) and one vmapped
+functional_call runs all of them in a single batched forward, unless a plain loop over
+the members measures faster on this machine (see Ensemble). The test split is
+forecast with the ensemble mean and quantiles, and the metrics of the mean, of every
+member and the coverage of the outer quantile band are reported, with the latency of
+the ensemble forward against a single member's.
+Arguments not listed below are passed on to the run.py parser.
+"""
+import argparse
+import copy
+import os
+import time
+
+import numpy as np
+import torch
+from torch.func import functional_call, stack_module_state, vmap
+
+from exp.exp_main import Exp_Main, model_dict
+from run import build_parser, finalize_args, get_setting
+from utils.benchmark import time_call
+from utils.metrics import metric
+
+
+class Ensemble:
+    """
+    K trained members of one model class evaluated as one batched model.
+
+    forward() returns the members' outputs stacked as [K, B, ...], computed either with
+    one vmapped call over the stacked parameters ('vmap') or member by member ('loop').
+    'auto' times both on the first batch and keeps the faster: vmap wins where the single
+    model leaves the device idle (GPU, many cores), while on few CPU cores the batched
+    matmuls over an expanded input can cost more than the plain loop. Models with ops that
+    have no vmap batching rule (nn.GRU, i.e. SegRNN) always loop.
+    """
+
+    def __init__(self, models, mode='auto'):
+        self.models = [m.eval() for m in models]
+        self.params, self.buffers = stack_module_state(self.models)
+        # stateless copy, functional_call supplies every parameter and buffer
+        self.base = copy.deepcopy(self.models[0]).to('meta')
+        self.mode = mode
+
+    def _member(self, params, buffers, *inputs):
+        return functional_call(self.base, (params, buffers), inputs)
+
+    def _run(self, mode, inputs):
+        if mode == 'vmap':
+            return vmap(self._member, in_dims=(0, 0) + (None,) * len(inputs))(self.params, self.buffers, *inputs)
+        return torch.stack([m(*inputs) for m in self.models])
+
+    def _choose_mode(self, inputs):
+        timings = {}
+        for mode in ('vmap', 'loop'):
+            try:
+                for _ in range(2):  # the second call, after warm-up
+                    start = time.perf_counter()
+                    self._run(mode, inputs)
+                timings[mode] = time.perf_counter() - start
+            except RuntimeError as e:
+                if 'Batching rule not implemented' not in str(e):
+                    raise
+                print('{} has no vmap batching rule ({})'.format(type(self.models[0]).__name__, str(e).split('.')[0]))
+        self.mode = min(timings, key=timings.get)
+        print('ensemble forward: {} ({})'.format(
+            self.mode, ', '.join('{} {:.2f}ms'.format(m, t * 1000) for m, t in timings.items())))
+
+    def forward(self, *inputs):
+        with torch.no_grad():
+            if self.mode == 'auto':
+                self._choose_mode(inputs)
+            return self._run(self.mode, inputs)
+
+    __call__ = forward
+
+    @staticmethod
+    def summarize(outputs, quantiles=()):
+        """Mean over the members and the requested quantiles, [Q, B, ...]."""
+        mean = outputs.mean(0)
+        if not quantiles:
+            return mean, None
+        q = torch.tensor(quantiles, dtype=outputs.dtype, device=outputs.device)
+        return mean, torch.quantile(outputs, q, dim=0)
+
+
+def load_members(args, checkpoint_dirs, device):
+    models = []
+    for checkpoint_dir in checkpoint_dirs:
+        model = model_dict[args.model].Model(args).float().to(device)
+        model.load_state_dict(torch.load(os.path.join(checkpoint_dir, 'checkpoint.pth'), map_location=device))
+        models.append(model)
+    return models
+
+
+def evaluate(exp, ensemble, quantiles):
+    args = exp.args
+    test_data, test_loader = exp._get_data(flag='test')
+    f_dim = -1 if args.features == 'MS' else 0
+    members, means, bands, trues = [], [], [], []
+    for batch_x, batch_y, batch_x_mark, batch_y_mark in test_loader:
+        batch_x = batch_x.float().to(exp.device)
+        batch_y = batch_y.float().to(exp.device)
+        batch_x_mark = batch_x_mark.float().to(exp.device)
+        batch_y_mark = batch_y_mark.float().to(exp.device)
+        dec_inp = torch.zeros_like(batch_y[:, -args.pred_len:, :])
+        dec_inp = torch.cat([batch_y[:, :args.label_len, :], dec_inp], dim=1)
+
+        outputs = ensemble(batch_x, batch_x_mark, dec_inp, batch_y_mark)[:, :, -args.pred_len:, f_dim:]
+        mean, band = Ensemble.summarize(outputs, quantiles)
+        members.append(outputs.cpu().numpy())
+        means.append(mean.cpu().numpy())
+        if band is not None:
+            bands.append(band.cpu().numpy())
+        trues.append(batch_y[:, -args.pred_len:, f_dim:].cpu().numpy())
+
+    inputs = (batch_x, batch_x_mark, dec_inp, batch_y_mark)
+
+    def single_member():
+        with torch.no_grad():
+            ensemble.models[0](*inputs)
+
+    single_ms = time_call(single_member)
+    ensemble_ms = time_call(lambda: ensemble(*inputs))
+    return (np.concatenate(members, axis=1), np.concatenate(means),
+            np.concatenate(bands, axis=1) if bands else None, np.concatenate(trues), single_ms, ensemble_ms)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batched ensemble of the --itr seed checkpoints of a setting',
+                                     epilog='all other arguments are passed on to run.py')
+    parser.add_argument('--checkpoint_dirs', type=str, default='',
+                        help='comma separated checkpoint directories, default: the --itr settings under --checkpoints')
+    parser.add_argument('--ensemble_mode', type=str, default='auto', choices=['auto', 'vmap', 'loop'])
+    parser.add_argument('--quantiles', type=lambda v: [float(q) for q in v.split(',') if q], default=[0.1, 0.5, 0.9])
+    ens_args, run_argv = parser.parse_known_args()
+
+    args = finalize_args(build_parser().parse_args(run_argv))
+    exp = Exp_Main(args)
+    settings = [get_setting(args, ii) for ii in range(args.itr)]
+    checkpoint_dirs = ens_args.checkpoint_dirs.split(',') if ens_args.checkpoint_dirs else \
+        [os.path.join(args.checkpoints, setting) for setting in settings]
+    ensemble = Ensemble(load_members(args, checkpoint_dirs, exp.device), ens_args.ensemble_mode)
+    print('ensemble of {} {} members'.format(len(checkpoint_dirs), args.model))
+
+    members, mean, band, trues, single_ms, ensemble_ms = evaluate(exp, ensemble, ens_args.quantiles)
+    for k, checkpoint_dir in enumerate(checkpoint_dirs):
+        mae, mse = metric(members[k], trues)[:2]
+        print('member {} mse:{}, mae:{}'.format(os.path.basename(os.path.normpath(checkpoint_dir)), mse, mae))
+    mae, mse, _, _, _, rse, _ = metric(mean, trues)
+    print('ensemble mean mse:{}, mae:{}, rse:{}'.format(mse, mae, rse))
+    if band is not None and len(ens_args.quantiles) > 1:
+        coverage = ((trues >= band[0]) & (trues <= band[-1])).mean()
+        print('q{}-q{} band covers {:.1%} of the targets'.format(ens_args.quantiles[0], ens_args.quantiles[-1], coverage))
+    print('latency per batch: single member {:.2f}ms, ensemble {:.2f}ms ({})'.format(
+        single_ms, ensemble_ms, ensemble.mode))
+
+    folder_path = os.path.join('./results', settings[0] + '_ensemble')
+    os.makedirs(folder_path, exist_ok=True)
+    np.save(os.path.join(folder_path, 'mean.npy'), mean)
+    if band is not None:
+        np.save(os.path.join(folder_path, 'quantiles.npy'), band)
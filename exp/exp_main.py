@@ -1,21 +1,30 @@
-from data_provider.data_factory import data_provider
+from data_provider.data_factory import data_provider, finetune_provider, distill_provider
+from data_provider.loader_tuning import tune_loader
 from exp.exp_basic import Exp_Basic
-from models import PatchMixer, SegRNN, iTransformer, TSMixer
-from utils.tools import EarlyStopping, adjust_learning_rate, visual, test_params_flop
-from utils.metrics import metric
+from exp.async_eval import AsyncEvaluator
+from models import model_dict
+from utils.tools import EarlyStopping, CheckpointWriter, StandardScaler, adjust_learning_rate, visual, \
+    test_params_flop, get_rng_state, set_rng_state
+from utils.metrics import METRIC_NAMES, metric, mean_ci
+from utils.profiler import StageTimer, NullTimer, TraceWindow
+from utils.forecast_cache import ForecastCache, model_identity
+from utils.results_db import ResultsStore, peak_memory_mb
 
 import numpy as np
 import torch
 import torch.nn as nn
 from torch import optim
-from torch.optim import lr_scheduler 
+from torch.utils.data import DataLoader
 
+import copy
+import hashlib
+import inspect
+import json
 import os
 import time
+import weakref
 
 import warnings
-import matplotlib.pyplot as plt
-import numpy as np
 
 warnings.filterwarnings('ignore')
 
@@ -23,17 +32,36 @@ from torch import Tensor
 import torch.nn.functional as F
 from torch.nn.modules import Module
 
+
+# models whose forward(..., channels=ids) runs on any subset of the enc_in channels
+CHANNEL_INDEPENDENT_MODELS = ['PatchMixer', 'SegRNN']
+
+
+class CustomLoss(Module):
+    """MSE + MAE, the dual objective used for PatchMixer"""
+
+    def forward(self, input: Tensor, target: Tensor) -> Tensor:
+        return F.mse_loss(input, target) + F.l1_loss(input, target)
+
+
 class Exp_Main(Exp_Basic):
     def __init__(self, args):
         super(Exp_Main, self).__init__(args)
+        self._eval_cache = weakref.WeakKeyDictionary()
+        self.forecast_cache = None
+        # rows of the runs of this experiment in the results database, by setting
+        self.results = ResultsStore(args.results_db) if args.results_db else None
+        self._run_ids = {}
+        if args.forecast_cache_mb:
+            self.forecast_cache = ForecastCache(args.forecast_cache_mb * 2 ** 20, args.forecast_cache_dir or None)
 
     def _build_model(self):
-        model_dict = {
-            'PatchMixer': PatchMixer,
-            'SegRNN': SegRNN,
-            'iTransformer': iTransformer,
-            'TSMixer': TSMixer
-        }
+        if self.args.sample_channels:
+            if self.args.model not in CHANNEL_INDEPENDENT_MODELS:
+                raise ValueError('--sample_channels needs a channel-independent model, one of {}'.format(
+                    ', '.join(CHANNEL_INDEPENDENT_MODELS)))
+            if self.args.features == 'MS':
+                raise ValueError('--sample_channels does not support --features MS, the target may not be sampled')
         model = model_dict[self.args.model].Model(self.args).float()
 
         if self.args.use_multi_gpu and self.args.use_gpu:
@@ -54,67 +82,142 @@ class Exp_Main(Exp_Basic):
         # criterion = nn.MSELoss() # origin one
         return criterion
 
+    def _eval_windows(self, data_set):
+        """
+        The dataset's series as float tensors on the device, cut into its
+        (x, y, x_mark, y_mark) windows with unfold. Built once per dataset, every
+        window is a view, so no per-window copy is kept.
+        """
+        if data_set in self._eval_cache:
+            return self._eval_cache[data_set]
+        seq_len, label_len, pred_len = data_set.seq_len, data_set.label_len, data_set.pred_len
+        data_x = torch.as_tensor(np.asarray(data_set.data_x), dtype=torch.float32).to(self.device)
+        data_y = torch.as_tensor(np.asarray(data_set.data_y), dtype=torch.float32).to(self.device)
+        data_stamp = torch.as_tensor(np.asarray(data_set.data_stamp, dtype=np.float32)).to(self.device)
+        n = len(data_set)
+        r_begin = seq_len - label_len
+        # unfold(0, size, 1) -> [num_windows, D, size], permuted to [num_windows, size, D]
+        windows = (data_x.unfold(0, seq_len, 1)[:n].permute(0, 2, 1),
+                   data_y.unfold(0, label_len + pred_len, 1)[r_begin:r_begin + n].permute(0, 2, 1),
+                   data_stamp.unfold(0, seq_len, 1)[:n].permute(0, 2, 1),
+                   data_stamp.unfold(0, label_len + pred_len, 1)[r_begin:r_begin + n].permute(0, 2, 1))
+        if getattr(data_set, 'eval_index', None) is not None:
+            # strided / sampled evaluation, see data_factory.eval_indices
+            index = torch.as_tensor(data_set.eval_index, device=self.device)
+            windows = tuple(w[index] for w in windows)
+        self._eval_cache[data_set] = windows
+        return windows
+
+    def _vali_batches(self, vali_data, vali_loader):
+        """
+        Device batches of the split: slices of the cached window views, or the loader's
+        batches for datasets not held as one array (Dataset_MultiSeries).
+        """
+        if not hasattr(vali_data, 'data_x'):
+            for batch_x, batch_y, batch_x_mark, batch_y_mark in vali_loader:
+                yield (batch_x.float().to(self.device), batch_y.float().to(self.device),
+                       batch_x_mark.float().to(self.device), batch_y_mark.float().to(self.device))
+            return
+        x_windows, y_windows, x_mark_windows, y_mark_windows = self._eval_windows(vali_data)
+        n = x_windows.shape[0]
+        eval_batch_size = self.args.eval_batch_size or self.args.batch_size
+        for start in range(0, n, eval_batch_size):
+            end = min(start + eval_batch_size, n)
+            yield (x_windows[start:end].contiguous(), y_windows[start:end].contiguous(),
+                   x_mark_windows[start:end].contiguous(), y_mark_windows[start:end].contiguous())
+
+    def _forward_channel_chunks(self, batch_x, batch_x_mark, dec_inp, batch_y_mark):
+        """
+        Forecast of every channel from a channel-independent model trained on
+        --sample_channels subsets: run on that many channels at a time and reassembled.
+        """
+        k = self.args.sample_channels
+        B, _, C = batch_x.shape
+        outputs = []
+        for start in range(0, C, k):
+            end = min(start + k, C)
+            channels = torch.arange(start, end, device=batch_x.device).expand(B, -1)
+            outputs.append(self.model(batch_x[..., start:end], batch_x_mark, dec_inp[..., start:end], batch_y_mark,
+                                      channels=channels))
+        return torch.cat(outputs, dim=-1)
+
     def vali(self, vali_data, vali_loader, criterion):
-        total_loss = []
+        n = 0
+        total_loss = torch.zeros((), device=self.device)
         self.model.eval()
         with torch.no_grad():
-            for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(vali_loader):
-                batch_x = batch_x.float().to(self.device)
-                batch_y = batch_y.float()
-
-                batch_x_mark = batch_x_mark.float().to(self.device)
-                batch_y_mark = batch_y_mark.float().to(self.device)
+            for batch_x, batch_y, batch_x_mark, batch_y_mark in self._vali_batches(vali_data, vali_loader):
+                n += batch_x.shape[0]
 
                 # decoder input
                 dec_inp = torch.zeros_like(batch_y[:, -self.args.pred_len:, :]).float()
                 dec_inp = torch.cat([batch_y[:, :self.args.label_len, :], dec_inp], dim=1).float().to(self.device)
                 # encoder - decoder
-                if self.args.use_amp:
-                    with torch.cuda.amp.autocast():
-                        if 'Linear' in self.args.model or 'TST' in self.args.model:
-                            outputs = self.model(batch_x, batch_x_mark)
-                        else:
-                            if self.args.output_attention:
-                                outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
-                            else:
-                                outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
-                else:
-                    if 'Linear' in self.args.model or 'TST' in self.args.model:
-                        outputs = self.model(batch_x)
-                    else:
-                        if self.args.output_attention:
-                            outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
-                        else:
-                            outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
+                outputs = self._forward(batch_x, batch_x_mark, dec_inp, batch_y_mark)
                 f_dim = -1 if self.args.features == 'MS' else 0
                 outputs = outputs[:, -self.args.pred_len:, f_dim:]
-                batch_y = batch_y[:, -self.args.pred_len:, f_dim:].to(self.device)
-
-                pred = outputs.detach().cpu()
-                true = batch_y.detach().cpu()
+                batch_y = batch_y[:, -self.args.pred_len:, f_dim:]
 
-                loss = criterion(pred, true)
-
-                total_loss.append(loss)
-        total_loss = np.average(total_loss)
+                # running sum of the per-window mean loss, read back once at the end
+                total_loss += criterion(outputs.float(), batch_y) * batch_x.shape[0]
         self.model.train()
-        return total_loss
+        return (total_loss / n).item()
+
+    def _step_time(self, train_data, steps=3):
+        """Seconds of one training step, forward and backward over the sub-batches of a batch, timed on a copy of the model."""
+        model = copy.deepcopy(self.model).train()
+        criterion = self._select_criterion()
+        batch = next(iter(DataLoader(train_data, batch_size=self.args.batch_size)))
+        batch_x, batch_y, batch_x_mark, batch_y_mark = (t.float().to(self.device) for t in batch[:4])
+        model_kwargs = {'channels': batch[4].to(self.device)} if len(batch) > 4 else {}
+        dec_inp = torch.zeros_like(batch_y[:, -self.args.pred_len:, :])
+        dec_inp = torch.cat([batch_y[:, :self.args.label_len, :], dec_inp], dim=1)
+        f_dim = -1 if self.args.features == 'MS' else 0
+        sub_batch_size = self.args.batch_size // 4
+        times = []
+        for _ in range(steps + 1):  # the first one warms up
+            start = time.perf_counter()
+            for j in range(0, batch_x.shape[0], sub_batch_size):
+                sub = slice(j, j + sub_batch_size)
+                outputs = model(batch_x[sub], batch_x_mark[sub], dec_inp[sub], batch_y_mark[sub],
+                                **{k: v[sub] for k, v in model_kwargs.items()})
+                criterion(outputs[:, -self.args.pred_len:, f_dim:], batch_y[sub, -self.args.pred_len:, f_dim:]).backward()
+            if self.device.type == 'cuda':
+                torch.cuda.synchronize(self.device)
+            times.append(time.perf_counter() - start)
+        return float(np.median(times[1:]))
 
     def train(self, setting):
         
+        # the loader draws its shuffle seed, the timing runs of --tune_loader shuffle and apply
+        # dropout: training with the tuned loader starts from the state before all of them
+        rng_state = get_rng_state()
         train_data, train_loader = self._get_data(flag='train')
+        if self.args.tune_loader:
+            num_workers, prefetch_factor = tune_loader(self.args, train_data, self._step_time(train_data))
+            set_rng_state(rng_state)
+            self.args.num_workers = num_workers
+            self.args.prefetch_factor = prefetch_factor or self.args.prefetch_factor
+            print('loader: {} workers{}, pin_memory {}'.format(
+                num_workers, ', prefetch {}, persistent'.format(prefetch_factor) if num_workers else '',
+                bool(self.args.use_gpu)))
+            train_data, train_loader = self._get_data(flag='train')
         vali_data, vali_loader = self._get_data(flag='val')
         test_data, test_loader = self._get_data(flag='test')
 
         path = os.path.join(self.args.checkpoints, setting)
         if not os.path.exists(path):
             os.makedirs(path)
+        # the normalization the weights are trained under, needed to serve or fine-tune them later
+        self._save_data_state(path, train_data)
 
         train_steps = len(train_loader)
-        early_stopping = EarlyStopping(patience=self.args.patience, verbose=True)
+        writer = CheckpointWriter()
+        early_stopping = EarlyStopping(patience=self.args.patience, verbose=True, writer=writer)
         model_optim = self._select_optimizer()
         criterion = self._select_criterion()
 
+        scaler = None
         if self.args.use_amp:
             scaler = torch.cuda.amp.GradScaler()
             
@@ -126,24 +229,66 @@ class Exp_Main(Exp_Basic):
             max_lr=self.args.learning_rate
         )
 
-        for epoch in range(self.args.train_epochs):
+        start_epoch = 0
+        pending_eval = {}
+        last_path = os.path.join(path, 'last.pth')
+        if self.args.resume and os.path.exists(last_path):
+            start_epoch, pending_eval = self._load_train_state(last_path, model_optim, scheduler, early_stopping, scaler)
+            print(f'Resuming {setting} from epoch {start_epoch + 1}')
+
+        timer = StageTimer(self.device) if self.args.profile else NullTimer()
+        trace = None
+        if self.args.trace_steps:
+            trace = TraceWindow(self.args.trace_start, self.args.trace_steps,
+                                os.path.join(path, 'trace.json'), self.device)
+        evaluator = AsyncEvaluator(self.args, self.model) if self.args.async_eval else None
+        for pending_epoch, snapshot in sorted(pending_eval.items()):
+            # submitted before the interruption and never collected, early stopping must still see it
+            if evaluator is not None:
+                evaluator.submit_snapshot(pending_epoch, snapshot)
+            else:
+                print(f'--async_eval is off, the evaluation of epoch {pending_epoch} pending in {last_path} is dropped')
+        run_id = self._start_run(setting)
+        epochs_run = start_epoch
+        train_start_time = time.time()
+
+        for epoch in range(start_epoch, self.args.train_epochs):
             torch.cuda.empty_cache()
             iter_count = 0
+            iter_samples = 0
+            epoch_samples = 0
             train_loss = []
 
             self.model.train()
             epoch_time = time.time()
-
-            for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(train_loader):
+            time_now = time.time()
+            if hasattr(train_loader.sampler, 'set_epoch'):
+                train_loader.sampler.set_epoch(epoch)
+            if hasattr(train_data, 'set_epoch'):
+                train_data.set_epoch(epoch)
+
+            for i, batch in enumerate(timer.iter(train_loader)):
+                batch_x, batch_y, batch_x_mark, batch_y_mark = batch[:4]
+                # channel-sampled batches (--sample_channels) also carry the ids of their channels
+                channels = batch[4] if len(batch) > 4 else None
+                if trace is not None:
+                    trace.step(epoch * train_steps + i)
+                iter_count += 1
                 batch_size = batch_x.size(0)
+                iter_samples += batch_size
+                epoch_samples += batch_size
                 sub_batch_size = self.args.batch_size // 4  # Process in smaller sub-batches
                 num_sub_batches = (batch_size + sub_batch_size - 1) // sub_batch_size
 
                 for j in range(num_sub_batches):
-                    sub_batch_x = batch_x[j * sub_batch_size:(j + 1) * sub_batch_size].float().to(self.device)
-                    sub_batch_y = batch_y[j * sub_batch_size:(j + 1) * sub_batch_size].float().to(self.device)
-                    sub_batch_x_mark = batch_x_mark[j * sub_batch_size:(j + 1) * sub_batch_size].float().to(self.device)
-                    sub_batch_y_mark = batch_y_mark[j * sub_batch_size:(j + 1) * sub_batch_size].float().to(self.device)
+                    with timer.stage('h2d'):
+                        sub_batch_x = batch_x[j * sub_batch_size:(j + 1) * sub_batch_size].float().to(self.device)
+                        sub_batch_y = batch_y[j * sub_batch_size:(j + 1) * sub_batch_size].float().to(self.device)
+                        sub_batch_x_mark = batch_x_mark[j * sub_batch_size:(j + 1) * sub_batch_size].float().to(self.device)
+                        sub_batch_y_mark = batch_y_mark[j * sub_batch_size:(j + 1) * sub_batch_size].float().to(self.device)
+                        model_kwargs = {}
+                        if channels is not None:
+                            model_kwargs['channels'] = channels[j * sub_batch_size:(j + 1) * sub_batch_size].to(self.device)
 
                     model_optim.zero_grad()
 
@@ -152,67 +297,113 @@ class Exp_Main(Exp_Basic):
 
                     if self.args.use_amp:
                         with torch.cuda.amp.autocast():
+                            with timer.stage('forward'):
+                                if self.args.output_attention:
+                                    outputs = self.model(sub_batch_x, sub_batch_x_mark, dec_inp, sub_batch_y_mark, **model_kwargs)[0]
+                                else:
+                                    outputs = self.model(sub_batch_x, sub_batch_x_mark, dec_inp, sub_batch_y_mark, **model_kwargs)
+
+                            with timer.stage('loss'):
+                                f_dim = -1 if self.args.features == 'MS' else 0
+                                outputs = outputs[:, -self.args.pred_len:, f_dim:]
+                                sub_batch_y = sub_batch_y[:, -self.args.pred_len:, f_dim:].to(self.device)
+                                loss = criterion(outputs, sub_batch_y)
+                    else:
+                        with timer.stage('forward'):
                             if self.args.output_attention:
-                                outputs = self.model(sub_batch_x, sub_batch_x_mark, dec_inp, sub_batch_y_mark)[0]
+                                outputs = self.model(sub_batch_x, sub_batch_x_mark, dec_inp, sub_batch_y_mark, **model_kwargs)[0]
                             else:
-                                outputs = self.model(sub_batch_x, sub_batch_x_mark, dec_inp, sub_batch_y_mark)
+                                outputs = self.model(sub_batch_x, sub_batch_x_mark, dec_inp, sub_batch_y_mark, **model_kwargs)
 
+                        with timer.stage('loss'):
                             f_dim = -1 if self.args.features == 'MS' else 0
                             outputs = outputs[:, -self.args.pred_len:, f_dim:]
                             sub_batch_y = sub_batch_y[:, -self.args.pred_len:, f_dim:].to(self.device)
                             loss = criterion(outputs, sub_batch_y)
-                    else:
-                        if self.args.output_attention:
-                            outputs = self.model(sub_batch_x, sub_batch_x_mark, dec_inp, sub_batch_y_mark)[0]
-                        else:
-                            outputs = self.model(sub_batch_x, sub_batch_x_mark, dec_inp, sub_batch_y_mark)
-
-                        f_dim = -1 if self.args.features == 'MS' else 0
-                        outputs = outputs[:, -self.args.pred_len:, f_dim:]
-                        sub_batch_y = sub_batch_y[:, -self.args.pred_len:, f_dim:].to(self.device)
-                        loss = criterion(outputs, sub_batch_y)
 
                     train_loss.append(loss.item())
 
                     if self.args.use_amp:
-                        scaler.scale(loss).backward()
-                        scaler.step(model_optim)
-                        scaler.update()
+                        with timer.stage('backward'):
+                            scaler.scale(loss).backward()
+                        with timer.stage('step'):
+                            scaler.step(model_optim)
+                            scaler.update()
                     else:
-                        loss.backward()
-                        model_optim.step()
+                        with timer.stage('backward'):
+                            loss.backward()
+                        with timer.stage('step'):
+                            model_optim.step()
+
+                timer.step(batch_size)
 
                 if (i + 1) % 100 == 0:
                     print(f"\titers: {i + 1}, epoch: {epoch + 1} | loss: {loss.item():.7f}")
-                    speed = (time.time() - epoch_time) / iter_count
+                    elapsed = time.time() - time_now
+                    speed = elapsed / iter_count
                     left_time = speed * ((self.args.train_epochs - epoch) * train_steps - i)
-                    print(f'\tspeed: {speed:.4f}s/iter; left time: {left_time:.4f}s')
+                    print(f'\tspeed: {speed:.4f}s/iter, {iter_samples / elapsed:.1f} samples/s; left time: {left_time:.4f}s')
+                    if self.args.profile:
+                        print(timer.report())
                     iter_count = 0
-                    epoch_time = time.time()
+                    iter_samples = 0
+                    time_now = time.time()
 
                 if self.args.lradj == 'TST':
                     adjust_learning_rate(model_optim, scheduler, epoch + 1, self.args, printout=False)
                     scheduler.step()
 
-            print(f"Epoch: {epoch + 1} cost time: {time.time() - epoch_time}")
+            epoch_cost = time.time() - epoch_time
+            print(f"Epoch: {epoch + 1} cost time: {epoch_cost}")
+            if self.args.profile:
+                print(timer.report())
             train_loss = np.average(train_loss)
-            vali_loss = self.vali(vali_data, vali_loader, criterion)
-            test_loss = self.vali(test_data, test_loader, criterion)
-
-            print(f"Epoch: {epoch + 1}, Steps: {train_steps} | Train Loss: {train_loss:.7f} Vali Loss: {vali_loss:.7f} Test Loss: {test_loss:.7f}")
-            early_stopping(vali_loss, self.model, path)
-            if early_stopping.early_stop:
-                print("Early stopping")
-                break
+            epochs_run = epoch + 1
+            self._log_epoch(run_id, epoch + 1, train_loss=train_loss, epoch_time=epoch_cost,
+                            samples_per_s=epoch_samples / epoch_cost)
+            if evaluator is not None and ((epoch + 1) % self.args.eval_every == 0 or epoch + 1 == self.args.train_epochs):
+                print(f"Epoch: {epoch + 1}, Steps: {train_steps} | Train Loss: {train_loss:.7f}")
+                # the previous snapshot was evaluated while this epoch trained,
+                # so early stopping acts one epoch late
+                self._apply_async_eval(evaluator.collect(), early_stopping, path, run_id)
+                if early_stopping.early_stop:
+                    print("Early stopping")
+                    break
+                evaluator.submit(epoch + 1, self.model)
+            elif (epoch + 1) % self.args.eval_every == 0 or epoch + 1 == self.args.train_epochs:
+                vali_loss = self.vali(vali_data, vali_loader, criterion)
+                test_loss = self.vali(test_data, test_loader, criterion)
+
+                print(f"Epoch: {epoch + 1}, Steps: {train_steps} | Train Loss: {train_loss:.7f} Vali Loss: {vali_loss:.7f} Test Loss: {test_loss:.7f}")
+                self._log_epoch(run_id, epoch + 1, vali_loss=vali_loss, test_loss=test_loss)
+                early_stopping(vali_loss, self.model, path)
+                if early_stopping.early_stop:
+                    print("Early stopping")
+                    break
+            else:
+                print(f"Epoch: {epoch + 1}, Steps: {train_steps} | Train Loss: {train_loss:.7f}")
 
             if self.args.lradj != 'TST':
                 adjust_learning_rate(model_optim, scheduler, epoch + 1, self.args)
             else:
                 print(f'Updating learning rate to {scheduler.get_last_lr()[0]}')
 
+            if self.args.checkpoint_every and (epoch + 1) % self.args.checkpoint_every == 0:
+                writer.save(self._train_state(epoch + 1, model_optim, scheduler, early_stopping, scaler,
+                                              evaluator.pending if evaluator is not None else None), last_path)
+
+        if trace is not None:
+            trace.close()
+        if evaluator is not None:
+            self._apply_async_eval(evaluator.collect(), early_stopping, path, run_id)
+            evaluator.close()
+        writer.close()
         train_end_time = time.time()
-        training_time = train_end_time - epoch_time
+        training_time = train_end_time - train_start_time
         num_params = sum(p.numel() for p in self.model.parameters() if p.requires_grad)
+        if self.results is not None:
+            self.results.update_run(run_id, params=num_params, train_time=training_time, epochs=epochs_run,
+                                    peak_mem_mb=peak_memory_mb(self.device))
 
         with open("result.txt", 'a') as f:
             f.write(f"Training time: {training_time:.4f} seconds\n")
@@ -222,135 +413,303 @@ class Exp_Main(Exp_Basic):
         self.model.load_state_dict(torch.load(best_model_path))
 
         return self.model
-    # def train(self, setting):
-    #     train_data, train_loader = self._get_data(flag='train')
-    #     vali_data, vali_loader = self._get_data(flag='val')
-    #     test_data, test_loader = self._get_data(flag='test')
 
-    #     path = os.path.join(self.args.checkpoints, setting)
-    #     if not os.path.exists(path):
-    #         os.makedirs(path)
+    def _save_data_state(self, path, data_set):
+        # the normalization the weights are trained under, how many rows the file had and
+        # how many of them training used, what finetune() needs to warm-start from this checkpoint
+        if data_set.scaler is not None:
+            torch.save(data_set.scaler.state_dict(), os.path.join(path, 'scaler.pth'))
+        with open(os.path.join(path, 'data.json'), 'w') as f:
+            json.dump({'data_path': self.args.data_path, 'rows': data_set.n_rows,
+                       'train_rows': data_set.train_rows}, f)
+        # the arguments the model was built with, e.g. to rebuild it as a distillation teacher
+        with open(os.path.join(path, 'args.json'), 'w') as f:
+            json.dump(vars(self.args), f, default=str)
+
+    def finetune(self, setting):
+        """
+        Warm start from the checkpoint in args.finetune_from and train args.finetune_epochs
+        epochs on the rows appended to the data file since, instead of retraining from scratch.
+        The new rows are the last args.new_rows, or everything after the row count recorded
+        with the checkpoint; --replay windows come from the rows the checkpoint was trained on.
+        Scaler stats are kept as they were, the weights depend on them.
+        """
+        source = self.args.finetune_from
+        self.model.load_state_dict(torch.load(os.path.join(source, 'checkpoint.pth'), map_location=self.device))
+        data_scaler = StandardScaler()
+        data_scaler.load_state_dict(torch.load(os.path.join(source, 'scaler.pth')))
+        with open(os.path.join(source, 'data.json')) as f:
+            data_state = json.load(f)
+        start_row = -self.args.new_rows if self.args.new_rows else data_state['rows']
+        # replay stays inside the rows the checkpoint was trained on, never its val/test rows
+        train_data, train_loader = finetune_provider(self.args, data_scaler, start_row,
+                                                     data_state.get('train_rows', data_state['rows']))
 
-    #     time_now = time.time()
-    #     train_start_time = time.time()
+        path = os.path.join(self.args.checkpoints, setting)
+        if not os.path.exists(path):
+            os.makedirs(path)
 
-    #     train_steps = len(train_loader)
-    #     early_stopping = EarlyStopping(patience=self.args.patience, verbose=True)
+        model_optim = self._select_optimizer()
+        criterion = self._select_criterion()
+        scaler = torch.cuda.amp.GradScaler() if self.args.use_amp else None
+        f_dim = -1 if self.args.features == 'MS' else 0
+        train_start_time = time.time()
 
-    #     model_optim = self._select_optimizer()
-    #     criterion = self._select_criterion()
+        for epoch in range(self.args.finetune_epochs):
+            train_loss = []
+            self.model.train()
+            epoch_time = time.time()
+            for batch_x, batch_y, batch_x_mark, batch_y_mark in train_loader:
+                batch_x = batch_x.float().to(self.device)
+                batch_y = batch_y.float().to(self.device)
+                batch_x_mark = batch_x_mark.float().to(self.device)
+                batch_y_mark = batch_y_mark.float().to(self.device)
+                model_optim.zero_grad()
 
-    #     if self.args.use_amp:
-    #         scaler = torch.cuda.amp.GradScaler()
-            
-    #     scheduler = lr_scheduler.OneCycleLR(optimizer = model_optim,
-    #                                         steps_per_epoch = train_steps,
-    #                                         pct_start = self.args.pct_start,
-    #                                         epochs = self.args.train_epochs,
-    #                                         max_lr = self.args.learning_rate)
-
-    #     for epoch in range(self.args.train_epochs):
-    #         torch.cuda.empty_cache()
-
-    #         iter_count = 0
-    #         train_loss = []
-
-    #         self.model.train()
-    #         epoch_time = time.time()
-    #         for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(train_loader):
-    #             iter_count += 1
-    #             model_optim.zero_grad()
-    #             batch_x = batch_x.float().to(self.device)
-
-    #             batch_y = batch_y.float().to(self.device)
-    #             batch_x_mark = batch_x_mark.float().to(self.device)
-    #             batch_y_mark = batch_y_mark.float().to(self.device)
-
-    #             # decoder input
-    #             dec_inp = torch.zeros_like(batch_y[:, -self.args.pred_len:, :]).float()
-    #             dec_inp = torch.cat([batch_y[:, :self.args.label_len, :], dec_inp], dim=1).float().to(self.device)
-
-    #             # encoder - decoder
-    #             if self.args.use_amp:
-    #                 with torch.cuda.amp.autocast():
-    #                     if 'Linear' in self.args.model or 'TST' in self.args.model:
-    #                         outputs = self.model(batch_x)
-    #                     else:
-    #                         if self.args.output_attention:
-    #                             outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
-    #                         else:
-    #                             outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
-
-    #                     f_dim = -1 if self.args.features == 'MS' else 0
-    #                     outputs = outputs[:, -self.args.pred_len:, f_dim:]
-    #                     batch_y = batch_y[:, -self.args.pred_len:, f_dim:].to(self.device)
-    #                     loss = criterion(outputs, batch_y)
-    #                     train_loss.append(loss.item())
-    #             else:
-    #                 if 'Linear' in self.args.model or 'TST' in self.args.model:
-    #                         outputs = self.model(batch_x)
-    #                 else:
-    #                     if self.args.output_attention:
-    #                         outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
-                            
-    #                     else:
-    #                         outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
-    #                 # print(outputs.shape,batch_y.shape)
-    #                 f_dim = -1 if self.args.features == 'MS' else 0
-    #                 outputs = outputs[:, -self.args.pred_len:, f_dim:]
-    #                 batch_y = batch_y[:, -self.args.pred_len:, f_dim:].to(self.device)
-    #                 loss = criterion(outputs, batch_y)
-    #                 train_loss.append(loss.item())
-
-    #             if (i + 1) % 100 == 0:
-    #                 print("\titers: {0}, epoch: {1} | loss: {2:.7f}".format(i + 1, epoch + 1, loss.item()))
-    #                 speed = (time.time() - time_now) / iter_count
-    #                 left_time = speed * ((self.args.train_epochs - epoch) * train_steps - i)
-    #                 print('\tspeed: {:.4f}s/iter; left time: {:.4f}s'.format(speed, left_time))
-    #                 iter_count = 0
-    #                 time_now = time.time()
-
-    #             if self.args.use_amp:
-    #                 scaler.scale(loss).backward()
-    #                 scaler.step(model_optim)
-    #                 scaler.update()
-    #             else:
-    #                 loss.backward()
-    #                 model_optim.step()
-                    
-    #             if self.args.lradj == 'TST':
-    #                 adjust_learning_rate(model_optim, scheduler, epoch + 1, self.args, printout=False)
-    #                 scheduler.step()
-
-    #         print("Epoch: {} cost time: {}".format(epoch + 1, time.time() - epoch_time))
-    #         train_loss = np.average(train_loss)
-    #         vali_loss = self.vali(vali_data, vali_loader, criterion)
-    #         test_loss = self.vali(test_data, test_loader, criterion)
-
-    #         print("Epoch: {0}, Steps: {1} | Train Loss: {2:.7f} Vali Loss: {3:.7f} Test Loss: {4:.7f}".format(
-    #             epoch + 1, train_steps, train_loss, vali_loss, test_loss))
-    #         early_stopping(vali_loss, self.model, path)
-    #         if early_stopping.early_stop:
-    #             print("Early stopping")
-    #             break
-
-    #         if self.args.lradj != 'TST':
-    #             adjust_learning_rate(model_optim, scheduler, epoch + 1, self.args)
-    #         else:
-    #             print('Updating learning rate to {}'.format(scheduler.get_last_lr()[0]))
-                
-    #     train_end_time = time.time() 
-    #     training_time = train_end_time - train_start_time
-    #     num_params = sum(p.numel() for p in self.model.parameters() if p.requires_grad)
-        
-    #     with open("result.txt", 'a') as f:
-    #         f.write(f"Training time: {training_time:.4f} seconds\n")
-    #         f.write(f"Number of parameters: {num_params}\n")
-            
-    #     best_model_path = path + '/' + 'checkpoint.pth'
-    #     self.model.load_state_dict(torch.load(best_model_path))
+                dec_inp = torch.zeros_like(batch_y[:, -self.args.pred_len:, :]).float()
+                dec_inp = torch.cat([batch_y[:, :self.args.label_len, :], dec_inp], dim=1).float().to(self.device)
+                outputs = self._forward(batch_x, batch_x_mark, dec_inp, batch_y_mark)
 
-    #     return self.model
+                outputs = outputs[:, -self.args.pred_len:, f_dim:]
+                batch_y = batch_y[:, -self.args.pred_len:, f_dim:]
+                loss = criterion(outputs.float(), batch_y)
+                if scaler is not None:
+                    scaler.scale(loss).backward()
+                    scaler.step(model_optim)
+                    scaler.update()
+                else:
+                    loss.backward()
+                    model_optim.step()
+                train_loss.append(loss.item())
+
+            print("Finetune epoch: {} cost time: {:.2f}s | Train Loss: {:.7f}".format(
+                epoch + 1, time.time() - epoch_time, np.average(train_loss)))
+
+        torch.save(self.model.state_dict(), os.path.join(path, 'checkpoint.pth'))
+        self._save_data_state(path, train_data)
+        with open("result.txt", 'a') as f:
+            f.write(setting + "  \n")
+            f.write(f"Finetune time: {time.time() - train_start_time:.4f} seconds on {train_data.new_windows} new "
+                    f"and {len(train_data) - train_data.new_windows} replayed windows\n\n")
+        return self.model
+
+    def _teacher_args(self):
+        """
+        Arguments the teacher in args.distill_from is built with: the ones it was trained
+        with (args.json next to its checkpoint), so its architecture may differ from the
+        student's in every flag, with this run's data location, devices and loaders.
+        Checkpoints without args.json get this run's arguments and --teacher_model.
+        """
+        teacher_args = copy.copy(self.args)
+        saved_path = os.path.join(self.args.distill_from, 'args.json')
+        if os.path.exists(saved_path):
+            with open(saved_path) as f:
+                saved = json.load(f)
+            run_args = ('root_path', 'data_path', 'checkpoints', 'use_gpu', 'gpu', 'use_multi_gpu', 'devices',
+                        'device_ids', 'use_amp', 'num_workers', 'prefetch_factor', 'cores', 'numa_node', 'threads',
+                        'interop_threads', 'loader_cores', 'loader_cores_resolved')
+            vars(teacher_args).update({k: v for k, v in saved.items() if k not in run_args})
+            # the teacher forecasts the student's training windows
+            mismatch = [k for k in ('seq_len', 'label_len', 'pred_len', 'features', 'enc_in', 'c_out', 'embed', 'freq')
+                        if getattr(teacher_args, k) != getattr(self.args, k)]
+            if mismatch:
+                raise ValueError('the teacher in {} was trained with other {} than this run'.format(
+                    self.args.distill_from, ', '.join('--' + k for k in mismatch)))
+        else:
+            teacher_args.model = self.args.teacher_model
+        teacher_args.forecast_cache_mb = 0
+        teacher_args.results_db = ''
+        return teacher_args
+
+    def _teacher_forecasts(self, train_data):
+        """
+        Forecasts of the teacher in args.distill_from (see _teacher_args) for every
+        training window. They are computed once and kept next to the teacher's checkpoint
+        as teacher_<key>.npy, the key covering the teacher's weights, the data and the
+        window shapes; later runs memory-map that file instead of running the teacher.
+        """
+        source = self.args.distill_from
+        teacher = Exp_Main(self._teacher_args())
+        teacher.model.load_state_dict(torch.load(os.path.join(source, 'checkpoint.pth'), map_location=self.device))
+
+        h = hashlib.blake2b(digest_size=10)
+        h.update(json.dumps([model_identity(teacher.model), self.args.data_path, getattr(train_data, 'n_rows', None),
+                             len(train_data), self.args.seq_len, self.args.label_len, self.args.pred_len,
+                             self.args.features, self.args.target]).encode())
+        cache_path = os.path.join(source, 'teacher_{}.npy'.format(h.hexdigest()))
+        if os.path.exists(cache_path):
+            print('teacher forecasts from {}'.format(cache_path))
+            return np.load(cache_path, mmap_mode='r')
+
+        start = time.time()
+        loader = DataLoader(train_data, batch_size=self.args.batch_size, shuffle=False,
+                            num_workers=self.args.num_workers)
+        preds = []
+        teacher.model.eval()
+        with torch.no_grad():
+            for batch_x, batch_y, batch_x_mark, batch_y_mark in loader:
+                batch_x = batch_x.float().to(self.device)
+                batch_y = batch_y.float().to(self.device)
+                batch_x_mark = batch_x_mark.float().to(self.device)
+                batch_y_mark = batch_y_mark.float().to(self.device)
+                dec_inp = torch.zeros_like(batch_y[:, -self.args.pred_len:, :]).float()
+                dec_inp = torch.cat([batch_y[:, :self.args.label_len, :], dec_inp], dim=1).float().to(self.device)
+                outputs = teacher._forward(batch_x, batch_x_mark, dec_inp, batch_y_mark)
+                preds.append(outputs[:, -self.args.pred_len:, :].float().cpu().numpy())
+        preds = np.concatenate(preds)
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, preds)
+        os.replace(tmp_path, cache_path)
+        print('{} forecasts of {} windows cached to {} in {:.2f}s'.format(
+            teacher.args.model, len(preds), cache_path, time.time() - start))
+        return preds
+
+    def distill(self, setting):
+        """
+        Train the model (a compact one, e.g. --model Student) on the teacher's forecasts:
+        the loss is args.distill_alpha times the loss against the forecasts of the teacher
+        in args.distill_from plus 1 - distill_alpha times the loss against the truth.
+        Early stopping watches the validation loss against the truth. The best weights are
+        also exported as a self-contained TorchScript module, student.pt, see export().
+        """
+        train_data, _ = self._get_data(flag='train')
+        vali_data, vali_loader = self._get_data(flag='val')
+        targets = self._teacher_forecasts(train_data)
+        _, train_loader = distill_provider(self.args, train_data, targets)
+
+        path = os.path.join(self.args.checkpoints, setting)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._save_data_state(path, train_data)
+
+        early_stopping = EarlyStopping(patience=self.args.patience, verbose=True)
+        model_optim = self._select_optimizer()
+        criterion = self._select_criterion()
+        alpha = self.args.distill_alpha
+        f_dim = -1 if self.args.features == 'MS' else 0
+        train_start_time = time.time()
+
+        for epoch in range(self.args.train_epochs):
+            train_loss = []
+            self.model.train()
+            epoch_time = time.time()
+            for batch_x, batch_y, batch_x_mark, batch_y_mark, batch_t in train_loader:
+                batch_x = batch_x.float().to(self.device)
+                batch_y = batch_y.float().to(self.device)
+                batch_x_mark = batch_x_mark.float().to(self.device)
+                batch_y_mark = batch_y_mark.float().to(self.device)
+                batch_t = batch_t.float().to(self.device)
+                model_optim.zero_grad()
+
+                dec_inp = torch.zeros_like(batch_y[:, -self.args.pred_len:, :]).float()
+                dec_inp = torch.cat([batch_y[:, :self.args.label_len, :], dec_inp], dim=1).float().to(self.device)
+                outputs = self._forward(batch_x, batch_x_mark, dec_inp, batch_y_mark)[:, -self.args.pred_len:, f_dim:]
+                loss = alpha * criterion(outputs, batch_t[:, :, f_dim:])
+                if alpha < 1:
+                    loss = loss + (1 - alpha) * criterion(outputs, batch_y[:, -self.args.pred_len:, f_dim:])
+                loss.backward()
+                model_optim.step()
+                train_loss.append(loss.item())
+
+            vali_loss = self.vali(vali_data, vali_loader, criterion)
+            print("Distill epoch: {} cost time: {:.2f}s | Train Loss: {:.7f} Vali Loss: {:.7f}".format(
+                epoch + 1, time.time() - epoch_time, np.average(train_loss), vali_loss))
+            early_stopping(vali_loss, self.model, path)
+            if early_stopping.early_stop:
+                print("Early stopping")
+                break
+
+        self.model.load_state_dict(torch.load(os.path.join(path, 'checkpoint.pth')))
+        num_params = sum(p.numel() for p in self.model.parameters() if p.requires_grad)
+        with open("result.txt", 'a') as f:
+            f.write(setting + "  \n")
+            f.write(f"Distill time: {time.time() - train_start_time:.4f} seconds from the teacher "
+                    f"in {self.args.distill_from}\n")
+            f.write(f"Number of parameters: {num_params}\n\n")
+        self.export(path, vali_data)
+        return self.model
+
+    def export(self, path, data_set):
+        """
+        Trace the model into path/student.pt, loadable with torch.jit.load(...) without this
+        code base. Models that only need the input window (Student) are called as module(x)
+        on [B, seq_len, C] scaled windows, the others with the full (x, x_mark, dec_inp,
+        y_mark) of Exp_Main; export.json records which, scaler.pth next to it holds the
+        scaling. Reports its latency on a single window.
+        """
+        seq_x, seq_y, seq_x_mark, seq_y_mark = (torch.as_tensor(np.asarray(a, dtype=np.float32), device=self.device)
+                                                .unsqueeze(0) for a in data_set[0][:4])
+        dec_inp = torch.cat([seq_y[:, :self.args.label_len], torch.zeros_like(seq_y[:, -self.args.pred_len:])], dim=1)
+        required = [p for p in inspect.signature(self.model.forward).parameters.values()
+                    if p.default is p.empty and p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)]
+        inputs = (seq_x,) if len(required) == 1 else (seq_x, seq_x_mark, dec_inp, seq_y_mark)
+        with open(os.path.join(path, 'export.json'), 'w') as f:
+            json.dump({'model': self.args.model, 'inputs': ['x', 'x_mark', 'dec_inp', 'y_mark'][:len(inputs)],
+                       'seq_len': self.args.seq_len, 'label_len': self.args.label_len,
+                       'pred_len': self.args.pred_len}, f, indent=2)
+        self.model.eval()
+        with torch.no_grad():
+            module = torch.jit.trace(self.model, inputs)
+            module.save(os.path.join(path, 'student.pt'))
+            for _ in range(10):
+                module(*inputs)
+            times = []
+            for _ in range(100):
+                start = time.perf_counter()
+                module(*inputs)
+                times.append(time.perf_counter() - start)
+        print('exported {} ({} parameters) to {}, {:.3f} ms per window'.format(
+            self.args.model, sum(p.numel() for p in self.model.parameters()), os.path.join(path, 'student.pt'),
+            np.median(times) * 1000))
+
+    def _start_run(self, setting):
+        # a new results row for every training of setting, test() then fills in its metrics
+        if self.results is None:
+            return None
+        self._run_ids[setting] = self.results.start_run(setting, self.args)
+        return self._run_ids[setting]
+
+    def _log_epoch(self, run_id, epoch, **values):
+        if self.results is not None:
+            self.results.log_epoch(run_id, epoch, **values)
+
+    def _apply_async_eval(self, result, early_stopping, path, run_id=None):
+        if result is None:
+            return
+        epoch, snapshot, vali_loss, test_loss = result
+        self._log_epoch(run_id, epoch, vali_loss=vali_loss, test_loss=test_loss)
+        print(f"Epoch: {epoch} (evaluated asynchronously) | Vali Loss: {vali_loss:.7f} Test Loss: {test_loss:.7f}")
+        early_stopping(vali_loss, snapshot, path)
+
+    def _train_state(self, epoch, model_optim, scheduler, early_stopping, scaler, pending_eval=None):
+        state = {
+            'epoch': epoch,
+            'model': self.model.state_dict(),
+            'optimizer': model_optim.state_dict(),
+            'scheduler': scheduler.state_dict(),
+            'early_stopping': early_stopping.state_dict(),
+            'rng': get_rng_state(),
+        }
+        if scaler is not None:
+            state['amp_scaler'] = scaler.state_dict()
+        if pending_eval:
+            # snapshots handed to the async evaluator whose results are not in early_stopping yet
+            state['pending_eval'] = pending_eval
+        return state
+
+    def _load_train_state(self, last_path, model_optim, scheduler, early_stopping, scaler):
+        # on the cpu: the rng state must stay a cpu ByteTensor, load_state_dict copies the
+        # model weights and optimizer moments onto the parameters' device
+        state = torch.load(last_path, map_location='cpu', weights_only=False)
+        self.model.load_state_dict(state['model'])
+        model_optim.load_state_dict(state['optimizer'])
+        scheduler.load_state_dict(state['scheduler'])
+        early_stopping.load_state_dict(state['early_stopping'])
+        if scaler is not None and 'amp_scaler' in state:
+            scaler.load_state_dict(state['amp_scaler'])
+        set_rng_state(state['rng'])
+        return state['epoch'], state.get('pending_eval', {})
 
     def test(self, setting, test=0):
         test_data, test_loader = self._get_data(flag='test')
@@ -379,24 +738,13 @@ class Exp_Main(Exp_Basic):
                 dec_inp = torch.zeros_like(batch_y[:, -self.args.pred_len:, :]).float()
                 dec_inp = torch.cat([batch_y[:, :self.args.label_len, :], dec_inp], dim=1).float().to(self.device)
                 # encoder - decoder
-                if self.args.use_amp:
-                    with torch.cuda.amp.autocast():
-                        if 'Linear' in self.args.model or 'TST' in self.args.model:
-                            outputs = self.model(batch_x)
-                        else:
-                            if self.args.output_attention:
-                                outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
-                            else:
-                                outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
-                else:
-                    if 'Linear' in self.args.model or 'TST' in self.args.model:
-                            outputs = self.model(batch_x)
-                    else:
-                        if self.args.output_attention:
-                            outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
+                outputs = self._forward(batch_x, batch_x_mark, dec_inp, batch_y_mark)
 
-                        else:
-                            outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
+                if self.args.inverse and test_data.scaler is not None and test_data.scale:
+                    # back to the data's own scale on the device, before the MS target slice
+                    outputs = test_data.scaler.inverse_transform(outputs)
+                    batch_y = test_data.scaler.inverse_transform(batch_y)
+                    batch_x = test_data.scaler.inverse_transform(batch_x)
 
                 f_dim = -1 if self.args.features == 'MS' else 0
                 # print(outputs.shape,batch_y.shape)
@@ -418,15 +766,12 @@ class Exp_Main(Exp_Basic):
                     visual(gt, pd, os.path.join(folder_path, str(i) + '.pdf'), data_name=setting, seq_len=batch_x.shape[1], pred_len=self.args.pred_len)
 
         if self.args.test_flop:
-            test_params_flop((batch_x.shape[1],batch_x.shape[2]))
+            test_params_flop(self.model, (batch_x, batch_x_mark, dec_inp, batch_y_mark))
             exit()
-        preds = np.array(preds)
-        trues = np.array(trues)
-        inputx = np.array(inputx)
-
-        preds = preds.reshape(-1, preds.shape[-2], preds.shape[-1])
-        trues = trues.reshape(-1, trues.shape[-2], trues.shape[-1])
-        inputx = inputx.reshape(-1, inputx.shape[-2], inputx.shape[-1])
+        # concatenated rather than stacked, the last batch of a strided/sampled split is smaller
+        preds = np.concatenate(preds)
+        trues = np.concatenate(trues)
+        inputx = np.concatenate(inputx)
 
         # result save
         folder_path = './results/' + setting + '/'
@@ -434,11 +779,32 @@ class Exp_Main(Exp_Basic):
             os.makedirs(folder_path)
 
         mae, mse, rmse, mape, mspe, rse, corr = metric(preds, trues)
+        if self.results is not None:
+            run_id = self._run_ids.get(setting) or self._start_run(setting)
+            # corr is per horizon step, stored as its mean like the other scores
+            self.results.update_run(run_id, **{name: float(np.mean(m)) for name, m in
+                                               zip(METRIC_NAMES, (mae, mse, rmse, mape, mspe, rse, corr))})
         print('mse:{}, mae:{}, rse:{}'.format(mse, mae, rse))
         f = open("result.txt", 'a')
         f.write(setting + "  \n")
         f.write('mse:{}, mae:{}, rse:{}'.format(mse, mae, rse))
         f.write('\n')
+        if self.args.eval_samples:
+            # windows are a random sample of the split, give the sampling error of the two means
+            err = preds - trues
+            mse_mean, mse_ci = mean_ci((err ** 2).mean(axis=(1, 2)), test_data.eval_population)
+            mae_mean, mae_ci = mean_ci(np.abs(err).mean(axis=(1, 2)), test_data.eval_population)
+            line = 'mse:{} +-{}, mae:{} +-{} (95% CI, {} of {} windows)'.format(
+                mse_mean, mse_ci, mae_mean, mae_ci, len(preds), test_data.eval_population)
+            print(line)
+            f.write(line)
+            f.write('\n')
+        # multi-horizon model: every shorter horizon is a prefix of the longest forecast
+        for h in self.args.horizons:
+            h_mae, h_mse, _, _, _, h_rse, _ = metric(preds[:, :h], trues[:, :h])
+            print('pl{} mse:{}, mae:{}, rse:{}'.format(h, h_mse, h_mae, h_rse))
+            f.write('pl{} mse:{}, mae:{}, rse:{}'.format(h, h_mse, h_mae, h_rse))
+            f.write('\n')
         f.write('\n')
         f.close()
 
@@ -446,7 +812,42 @@ class Exp_Main(Exp_Basic):
         np.save(folder_path + 'pred.npy', preds)
         # np.save(folder_path + 'true.npy', trues)
         # np.save(folder_path + 'x.npy', inputx)
-        return
+        return mae, mse, rmse, mape, mspe, rse, corr
+
+    def _forward(self, batch_x, batch_x_mark, dec_inp, batch_y_mark):
+        """Outputs of the model on a device batch outside train(): vali, test, forecast, fine-tuning and distillation."""
+        if self.args.sample_channels:
+            outputs = self._forward_channel_chunks(batch_x, batch_x_mark, dec_inp, batch_y_mark)
+        elif self.args.use_amp:
+            with torch.cuda.amp.autocast():
+                if 'Linear' in self.args.model or 'TST' in self.args.model:
+                    outputs = self.model(batch_x)
+                else:
+                    if self.args.output_attention:
+                        outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
+                    else:
+                        outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
+        else:
+            if 'Linear' in self.args.model or 'TST' in self.args.model:
+                outputs = self.model(batch_x)
+            else:
+                if self.args.output_attention:
+                    outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
+                else:
+                    outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
+        return outputs
+
+    def forecast(self, batch_x, batch_x_mark, dec_inp, batch_y_mark):
+        """
+        Model outputs for a batch of prepared inputs, the entry point of predict() and of any
+        serving code. With --forecast_cache_mb, windows seen before with the same weights
+        and pred_len are answered from the cache instead of the model.
+        """
+        if self.forecast_cache is None:
+            return self._forward(batch_x, batch_x_mark, dec_inp, batch_y_mark)
+        # the digest of the weights as they are now, however they were changed since the last call
+        return self.forecast_cache.forecast(model_identity(self.model), self.args.pred_len,
+                                            (batch_x, batch_x_mark, dec_inp, batch_y_mark), self._forward)
 
     def predict(self, setting, load=False):
         pred_data, pred_loader = self._get_data(flag='pred')
@@ -470,23 +871,9 @@ class Exp_Main(Exp_Basic):
                 dec_inp = torch.zeros([batch_y.shape[0], self.args.pred_len, batch_y.shape[2]]).float().to(batch_y.device)
                 dec_inp = torch.cat([batch_y[:, :self.args.label_len, :], dec_inp], dim=1).float().to(self.device)
                 # encoder - decoder
-                if self.args.use_amp:
-                    with torch.cuda.amp.autocast():
-                        if 'Linear' in self.args.model or 'TST' in self.args.model:
-                            outputs = self.model(batch_x)
-                        else:
-                            if self.args.output_attention:
-                                outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
-                            else:
-                                outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
-                else:
-                    if 'Linear' in self.args.model or 'TST' in self.args.model:
-                        outputs = self.model(batch_x)
-                    else:
-                        if self.args.output_attention:
-                            outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
-                        else:
-                            outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
+                outputs = self.forecast(batch_x, batch_x_mark, dec_inp, batch_y_mark)
+                if self.args.inverse and pred_data.scale:
+                    outputs = pred_data.scaler.inverse_transform(outputs)
                 pred = outputs.detach().cpu().numpy()  # .squeeze()
                 preds.append(pred)
 
@@ -499,5 +886,7 @@ class Exp_Main(Exp_Basic):
             os.makedirs(folder_path)
 
         np.save(folder_path + 'real_prediction.npy', preds)
+        if self.forecast_cache is not None:
+            print(self.forecast_cache.report())
 
         return
@@ -0,0 +1,258 @@
+import copy
+import os
+import time
+
+import numpy as np
+import torch
+from torch.func import functional_call, stack_module_state, vmap
+
+from exp.exp_main import Exp_Main
+from utils.tools import EarlyStopping, adjust_learning_rate
+
+
+class Exp_MultiSeed(Exp_Main):
+    """
+    Trains the --itr replicas of a setting together in one process (run.py --parallel_itr).
+
+    Replica k is initialized with seed random_seed + k and all replicas see the same
+    batches. In 'vmap' mode their parameters are stacked and one vmapped functional_call
+    computes the K losses (dropout masks differ per replica); in 'loop' mode the K models
+    run one after the other on each batch. Either way a single AdamW steps all parameters,
+    which is exactly K independent optimizers, as Adam's state is per element. 'auto' times
+    one forward/backward of both on the first batch and keeps the faster (vmap pays off
+    on GPU and many cores, less so on a few CPU cores; SegRNN's GRU cannot be vmapped).
+    Every replica has its own EarlyStopping and checkpoint directory, the same layout
+    as sequential --itr runs, so test() and exp.ensemble work on the result unchanged.
+    A replica that stops early leaves the stack (self.active lists the ones still
+    training), its weights stay as saved and it costs no more compute.
+    """
+
+    def _build_replicas(self, n):
+        models = []
+        for k in range(n):
+            torch.manual_seed(self.args.random_seed + k)
+            models.append(self._build_model().to(self.device))
+        return models
+
+    def _stack(self, models):
+        self.params, self.buffers = stack_module_state(models)
+        # stateless copy, functional_call supplies every parameter and buffer
+        self.base = copy.deepcopy(models[0]).to('meta')
+
+    def _losses(self, mode, criterion, batch_x, batch_x_mark, dec_inp, batch_y_mark, batch_y):
+        """Loss of every replica on the batch, [K]."""
+        f_dim = -1 if self.args.features == 'MS' else 0
+        target = batch_y[:, -self.args.pred_len:, f_dim:]
+        if mode == 'vmap':
+            def replica_loss(params, buffers):
+                outputs = functional_call(self.base, (params, buffers), (batch_x, batch_x_mark, dec_inp, batch_y_mark))
+                return criterion(outputs[:, -self.args.pred_len:, f_dim:], target)
+            return vmap(replica_loss, randomness='different')(self.params, self.buffers)
+        return torch.stack([criterion(m(batch_x, batch_x_mark, dec_inp, batch_y_mark)[:, -self.args.pred_len:, f_dim:],
+                                      target) for m in self._active_replicas()])
+
+    def _choose_mode(self, criterion, inputs):
+        # the timed steps must not leave a trace in the batch norm statistics
+        buffers = {name: b.clone() for name, b in self.buffers.items()}
+        replica_buffers = [{name: b.clone() for name, b in m.named_buffers()} for m in self.replicas]
+        timings = {}
+        for mode in ('vmap', 'loop'):
+            try:
+                for _ in range(2):  # the second call, after warm-up
+                    start = time.perf_counter()
+                    self._losses(mode, criterion, *inputs).sum().backward()
+                timings[mode] = time.perf_counter() - start
+            except RuntimeError as e:
+                # without a batching rule the replicas fall back to the loop, whose errors are real
+                if mode != 'vmap' or 'Batching rule not implemented' not in str(e):
+                    raise
+                print('{} has no vmap batching rule ({})'.format(self.args.model, str(e).split('.')[0]))
+        for p in self._parameters():
+            p.grad = None
+        with torch.no_grad():
+            for name, b in self.buffers.items():
+                b.copy_(buffers[name])
+            for m, saved in zip(self.replicas, replica_buffers):
+                for name, b in m.named_buffers():
+                    b.copy_(saved[name])
+        mode = min(timings, key=timings.get)
+        print('replica training: {} ({})'.format(
+            mode, ', '.join('{} {:.2f}ms'.format(m, t * 1000) for m, t in timings.items())))
+        return mode
+
+    def _parameters(self):
+        return list(self.params.values()) + [p for m in self.replicas for p in m.parameters()]
+
+    def _active_replicas(self):
+        return [self.replicas[k] for k in self.active]
+
+    def _replica_state(self, mode, i):
+        """State dict of the i-th active replica."""
+        if mode == 'vmap':
+            state = {name: p[i].detach().clone() for name, p in self.params.items()}
+            state.update({name: b[i].clone() for name, b in self.buffers.items()})
+            return state
+        return {name: t.detach().clone() for name, t in self.replicas[self.active[i]].state_dict().items()}
+
+    def _drop(self, mode, stopped, model_optim):
+        """
+        Take the replicas in stopped out of training. With zero gradients AdamW would
+        still move their weights (momentum, weight decay), so they leave the optimizer:
+        in vmap mode the stacked parameters and their Adam moments are cut down to the
+        remaining replicas, in loop mode their parameters are removed from it.
+        """
+        keep = [i for i, k in enumerate(self.active) if k not in stopped]
+        if mode == 'vmap':
+            index = torch.tensor(keep, device=self.device)
+            params = {}
+            for name, p in self.params.items():
+                params[name] = p.detach()[index].requires_grad_(p.requires_grad)
+                state = model_optim.state.pop(p, {})
+                # per element moments are stacked like the parameter, the step count is shared
+                model_optim.state[params[name]] = {key: v[index] if torch.is_tensor(v) and v.dim() else v
+                                                   for key, v in state.items()}
+            replaced = {id(p): params[name] for name, p in self.params.items()}
+            for group in model_optim.param_groups:
+                group['params'] = [replaced[id(p)] for p in group['params']]
+            self.params = params
+            self.buffers = {name: b[index] for name, b in self.buffers.items()}
+        else:
+            dropped = [p for k in stopped for p in self.replicas[k].parameters()]
+            ids = {id(p) for p in dropped}
+            for group in model_optim.param_groups:
+                group['params'] = [p for p in group['params'] if id(p) not in ids]
+            for p in dropped:
+                model_optim.state.pop(p, None)
+        self.active = [self.active[i] for i in keep]
+
+    def _set_training(self, training):
+        self.base.train(training)
+        for m in self.replicas:
+            m.train(training)
+
+    def _vali_losses(self, mode, vali_data, vali_loader, criterion):
+        total = torch.zeros(len(self.active), device=self.device)
+        n = 0
+        self._set_training(False)
+        with torch.no_grad():
+            for batch_x, batch_y, batch_x_mark, batch_y_mark in self._vali_batches(vali_data, vali_loader):
+                dec_inp = torch.zeros_like(batch_y[:, -self.args.pred_len:, :]).float()
+                dec_inp = torch.cat([batch_y[:, :self.args.label_len, :], dec_inp], dim=1).float().to(self.device)
+                total += self._losses(mode, criterion, batch_x, batch_x_mark, dec_inp, batch_y_mark, batch_y) \
+                    * batch_x.shape[0]
+                n += batch_x.shape[0]
+        self._set_training(True)
+        return (total / n).tolist()
+
+    def train_replicas(self, settings):
+        train_data, train_loader = self._get_data(flag='train')
+        vali_data, vali_loader = self._get_data(flag='val')
+        test_data, test_loader = self._get_data(flag='test')
+
+        paths = [os.path.join(self.args.checkpoints, setting) for setting in settings]
+        for path in paths:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            self._save_data_state(path, train_data)
+
+        self.replicas = self._build_replicas(len(settings))
+        self._stack(self.replicas)
+        self.active = list(range(len(settings)))
+        criterion = self._select_criterion()
+        early_stopping = [EarlyStopping(patience=self.args.patience) for _ in settings]
+        train_steps = len(train_loader)
+        mode = self.args.replica_mode
+        model_optim = None
+        scheduler = None
+        run_ids = [self._start_run(setting) for setting in settings]
+        train_start_time = time.time()
+
+        for epoch in range(self.args.train_epochs):
+            train_loss = []
+            self._set_training(True)
+            epoch_time = time.time()
+            for batch_x, batch_y, batch_x_mark, batch_y_mark in train_loader:
+                batch_size = batch_x.size(0)
+                sub_batch_size = self.args.batch_size // 4  # same sub-batches as Exp_Main.train
+                for j in range(0, batch_size, sub_batch_size):
+                    sub_batch_x = batch_x[j:j + sub_batch_size].float().to(self.device)
+                    sub_batch_y = batch_y[j:j + sub_batch_size].float().to(self.device)
+                    sub_batch_x_mark = batch_x_mark[j:j + sub_batch_size].float().to(self.device)
+                    sub_batch_y_mark = batch_y_mark[j:j + sub_batch_size].float().to(self.device)
+                    dec_inp = torch.zeros_like(sub_batch_y[:, -self.args.pred_len:, :]).float()
+                    dec_inp = torch.cat([sub_batch_y[:, :self.args.label_len, :], dec_inp], dim=1).float().to(self.device)
+                    inputs = (sub_batch_x, sub_batch_x_mark, dec_inp, sub_batch_y_mark, sub_batch_y)
+
+                    if model_optim is None:
+                        if mode == 'auto':
+                            mode = self._choose_mode(criterion, inputs)
+                        params = list(self.params.values()) if mode == 'vmap' else \
+                            [p for m in self.replicas for p in m.parameters()]
+                        model_optim = torch.optim.AdamW(params, lr=self.args.learning_rate)
+                        scheduler = torch.optim.lr_scheduler.OneCycleLR(
+                            optimizer=model_optim,
+                            steps_per_epoch=train_steps,
+                            pct_start=self.args.pct_start,
+                            epochs=self.args.train_epochs,
+                            max_lr=self.args.learning_rate
+                        )
+
+                    model_optim.zero_grad()
+                    losses = self._losses(mode, criterion, *inputs)
+                    # replicas are independent, the gradient of the sum is each one's own gradient
+                    losses.sum().backward()
+                    model_optim.step()
+                    train_loss.append(losses.detach())
+
+                if self.args.lradj == 'TST':
+                    adjust_learning_rate(model_optim, scheduler, epoch + 1, self.args, printout=False)
+                    scheduler.step()
+
+            # losses are per active replica, the i-th belonging to replica self.active[i]
+            train_loss = torch.stack(train_loss).mean(0).tolist()
+            vali_loss = self._vali_losses(mode, vali_data, vali_loader, criterion)
+            test_loss = self._vali_losses(mode, test_data, test_loader, criterion)
+            epoch_cost = time.time() - epoch_time
+            print(f"Epoch: {epoch + 1} cost time: {epoch_cost}")
+            stopped = []
+            for i, k in enumerate(self.active):
+                print(f"\treplica {k} | Train Loss: {train_loss[i]:.7f} Vali Loss: {vali_loss[i]:.7f} "
+                      f"Test Loss: {test_loss[i]:.7f}")
+                self._log_epoch(run_ids[k], epoch + 1, train_loss=train_loss[i], vali_loss=vali_loss[i],
+                                test_loss=test_loss[i], epoch_time=epoch_cost)
+                early_stopping[k](vali_loss[i], self._replica_state(mode, i), paths[k])
+                if early_stopping[k].early_stop:
+                    print(f"\treplica {k} early stopping")
+                    stopped.append(k)
+            if len(stopped) == len(self.active):
+                print("Early stopping")
+                break
+            if stopped:
+                self._drop(mode, stopped, model_optim)
+
+            if self.args.lradj != 'TST':
+                adjust_learning_rate(model_optim, scheduler, epoch + 1, self.args)
+            else:
+                print(f'Updating learning rate to {scheduler.get_last_lr()[0]}')
+
+        training_time = time.time() - train_start_time
+        if self.results is not None:
+            num_params = sum(p.numel() for p in self.model.parameters() if p.requires_grad)
+            for run_id in run_ids:
+                # the replicas trained together, each row gets the shared wall time
+                self.results.update_run(run_id, params=num_params, train_time=training_time, epochs=epoch + 1)
+        with open("result.txt", 'a') as f:
+            f.write(f"Training time: {training_time:.4f} seconds for {len(settings)} replicas ({mode})\n")
+            f.write(f"Number of parameters: {sum(p.numel() for p in self.model.parameters() if p.requires_grad)}\n")
+        print(f'{len(settings)} replicas trained in {training_time:.1f}s')
+
+    def test_replicas(self, settings):
+        results = []
+        for setting in settings:
+            path = os.path.join(self.args.checkpoints, setting)
+            self.model.load_state_dict(torch.load(os.path.join(path, 'checkpoint.pth'), map_location=self.device))
+            print('>>>>>>>testing : {}<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'.format(setting))
+            results.append(self.test(setting))
+        mse = np.array([r[1] for r in results])
+        print('mse over {} replicas: {:.6f} +- {:.6f}'.format(len(results), mse.mean(), mse.std()))
+        return results
@@ -0,0 +1,170 @@
+"""
+Structured pruning of a trained checkpoint.
+
+    python -m exp.prune --model PatchMixer --seq_len 336 --pred_len 96 --prune_ratio 0.5
+    python -m exp.prune --model TSMixer --seq_len 96 --pred_len 24 --prune_ratio 0.75 --prune_epochs 3
+
+Every two-layer MLP of the model (a module with Linear fc1 and fc2 around an element-wise
+activation: PatchMixer's Mlp, TSMixer's Mlp, exp_ts' Mlp_feat) loses the --prune_ratio
+fraction of its hidden neurons with the smallest weight magnitude, and fc1/fc2 are rebuilt
+as smaller dense layers. The pruned model is optionally fine-tuned with the usual training
+loop for --prune_epochs and saved, with the hidden sizes in prune.json, under
+<setting>_pruned<ratio>. Parameters, MACs, latency and test metrics are reported before
+and after. Arguments not listed below are passed on to the run.py parser.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from exp.exp_main import Exp_Main
+from run import build_parser, finalize_args, get_setting
+from utils.benchmark import time_call
+from utils.flops import count_model
+from utils.metrics import metric
+
+
+def prunable(model):
+    """(name, module) of the MLPs whose hidden width can change without touching the rest of the model."""
+    for name, module in model.named_modules():
+        fc1, fc2 = getattr(module, 'fc1', None), getattr(module, 'fc2', None)
+        if isinstance(fc1, nn.Linear) and isinstance(fc2, nn.Linear) and fc1.out_features == fc2.in_features:
+            yield name, module
+
+
+def neuron_scores(module):
+    """Magnitude of every hidden neuron: norm of its fc1 row (with bias) times norm of its fc2 column."""
+    w_in = module.fc1.weight
+    if module.fc1.bias is not None:
+        w_in = torch.cat([w_in, module.fc1.bias[:, None]], dim=1)
+    return w_in.norm(dim=1) * module.fc2.weight.norm(dim=0)
+
+
+def _resize(module, hidden):
+    fc1, fc2 = module.fc1, module.fc2
+    module.fc1 = nn.Linear(fc1.in_features, hidden, bias=fc1.bias is not None).to(fc1.weight)
+    module.fc2 = nn.Linear(hidden, fc2.out_features, bias=fc2.bias is not None).to(fc2.weight)
+
+
+def prune_mlp(module, ratio):
+    """Keep the 1 - ratio strongest hidden neurons (at least one) of module; returns the new width."""
+    hidden = module.fc1.out_features
+    keep = max(1, int(round(hidden * (1 - ratio))))
+    index = neuron_scores(module).topk(keep).indices.sort().values
+    fc1, fc2 = module.fc1, module.fc2
+    _resize(module, keep)
+    with torch.no_grad():
+        module.fc1.weight.copy_(fc1.weight[index])
+        module.fc2.weight.copy_(fc2.weight[:, index])
+        if fc1.bias is not None:
+            module.fc1.bias.copy_(fc1.bias[index])
+        if fc2.bias is not None:
+            module.fc2.bias.copy_(fc2.bias)
+    return keep
+
+
+def prune_model(model, ratio):
+    """Prune every MLP of model in place; returns {module name: (old width, new width)}."""
+    widths = {}
+    for name, module in list(prunable(model)):
+        old = module.fc1.out_features
+        widths[name] = (old, prune_mlp(module, ratio))
+    return widths
+
+
+def load_pruned(model, checkpoint_dir):
+    """Shrink a freshly built model to the widths in checkpoint_dir/prune.json and load its weights."""
+    with open(os.path.join(checkpoint_dir, 'prune.json')) as f:
+        widths = json.load(f)['widths']
+    modules = dict(model.named_modules())
+    for name, hidden in widths.items():
+        _resize(modules[name], hidden)
+    device = next(model.parameters()).device
+    model.load_state_dict(torch.load(os.path.join(checkpoint_dir, 'checkpoint.pth'), map_location=device))
+    return model
+
+
+def evaluate(exp, test_loader):
+    """Test metrics, MACs and parameters of exp.model and its median latency on one test batch."""
+    args = exp.args
+    f_dim = -1 if args.features == 'MS' else 0
+    preds, trues = [], []
+    exp.model.eval()
+    with torch.no_grad():
+        for batch_x, batch_y, batch_x_mark, batch_y_mark in test_loader:
+            batch_x = batch_x.float().to(exp.device)
+            batch_y = batch_y.float().to(exp.device)
+            batch_x_mark = batch_x_mark.float().to(exp.device)
+            batch_y_mark = batch_y_mark.float().to(exp.device)
+            dec_inp = torch.zeros_like(batch_y[:, -args.pred_len:, :])
+            dec_inp = torch.cat([batch_y[:, :args.label_len, :], dec_inp], dim=1)
+            outputs = exp._forward(batch_x, batch_x_mark, dec_inp, batch_y_mark)
+            preds.append(outputs[:, -args.pred_len:, f_dim:].cpu().numpy())
+            trues.append(batch_y[:, -args.pred_len:, f_dim:].cpu().numpy())
+    mae, mse = metric(np.concatenate(preds), np.concatenate(trues))[:2]
+    inputs = (batch_x, batch_x_mark, dec_inp, batch_y_mark)
+    macs, params, _ = count_model(exp.model, inputs)
+
+    def forward():
+        with torch.no_grad():
+            exp.model(*inputs)
+
+    return {'mse': float(mse), 'mae': float(mae), 'params': params, 'macs': macs, 'latency_ms': time_call(forward)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Structured pruning of the MLPs of a trained checkpoint',
+                                     epilog='all other arguments are passed on to run.py')
+    parser.add_argument('--checkpoint_dir', type=str, default='',
+                        help='directory of checkpoint.pth, default: the run.py setting under --checkpoints')
+    parser.add_argument('--prune_ratio', type=float, default=0.5, help='fraction of hidden neurons to remove')
+    parser.add_argument('--prune_epochs', type=int, default=0, help='fine-tune epochs after pruning, 0: none')
+    pr_args, run_argv = parser.parse_known_args()
+    if not 0 <= pr_args.prune_ratio < 1:
+        parser.error('--prune_ratio must be in [0, 1)')
+
+    args = finalize_args(build_parser().parse_args(run_argv))
+    torch.manual_seed(args.random_seed)
+    exp = Exp_Main(args)
+    setting = get_setting(args, 0)
+    checkpoint_dir = pr_args.checkpoint_dir or os.path.join(args.checkpoints, setting)
+    exp.model.load_state_dict(torch.load(os.path.join(checkpoint_dir, 'checkpoint.pth'), map_location=exp.device))
+    test_data, test_loader = exp._get_data(flag='test')
+
+    before = evaluate(exp, test_loader)
+    widths = prune_model(exp.model, pr_args.prune_ratio)
+    if not widths:
+        raise SystemExit('{} has no prunable MLP'.format(args.model))
+    for name, (old, new) in widths.items():
+        print('pruned {}: {} -> {} hidden neurons'.format(name, old, new))
+
+    pruned_setting = '{}_pruned{}'.format(setting, pr_args.prune_ratio)
+    path = os.path.join(args.checkpoints, pruned_setting)
+    os.makedirs(path, exist_ok=True)
+    pruned = evaluate(exp, test_loader)
+    rows = [('trained', before), ('pruned', pruned)]
+    if pr_args.prune_epochs:
+        args.train_epochs = pr_args.prune_epochs
+        args.resume = False
+        print('>>>>>>>fine-tuning : {}>>>>>>>>>>>>>>>>>>>>>>>>>>'.format(pruned_setting))
+        exp.train(pruned_setting)
+        rows.append(('fine-tuned', evaluate(exp, test_loader)))
+    else:
+        torch.save(exp.model.state_dict(), os.path.join(path, 'checkpoint.pth'))
+        exp._save_data_state(path, exp._get_data(flag='train')[0])
+    with open(os.path.join(path, 'prune.json'), 'w') as f:
+        json.dump({'source': checkpoint_dir, 'ratio': pr_args.prune_ratio,
+                   'widths': {name: new for name, (_, new) in widths.items()}}, f, indent=2)
+
+    print('{:<11}{:>10}{:>14}{:>12}{:>11}{:>11}'.format('', 'params', 'MACs', 'latency_ms', 'mse', 'mae'))
+    for label, r in rows:
+        print('{:<11}{:>10}{:>14}{:>12.2f}{:>11.6f}{:>11.6f}'.format(
+            label, r['params'], r['macs'], r['latency_ms'], r['mse'], r['mae']))
+    last = rows[-1][1]
+    print('params {:+.1%}, MACs {:+.1%}, latency {:+.1%}, mse {:+.6f}'.format(
+        last['params'] / before['params'] - 1, last['macs'] / before['macs'] - 1,
+        last['latency_ms'] / before['latency_ms'] - 1, last['mse'] - before['mse']))
+    print('pruned checkpoint written to {}'.format(path))
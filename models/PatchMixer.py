@@ -20,12 +20,13 @@ class RevIN(nn.Module):
         if self.affine:
             self._init_params()
 
-    def forward(self, x, mode:str):
+    def forward(self, x, mode:str, channels=None):
+        # channels: B, C ids of the channels in x when it holds a subset of num_features
         if mode == 'norm':
             self._get_statistics(x)
-            x = self._normalize(x)
+            x = self._normalize(x, channels)
         elif mode == 'denorm':
-            x = self._denormalize(x)
+            x = self._denormalize(x, channels)
         else: raise NotImplementedError
         return x
 
@@ -42,21 +43,28 @@ class RevIN(nn.Module):
             self.mean = torch.mean(x, dim=dim2reduce, keepdim=True).detach()
         self.stdev = torch.sqrt(torch.var(x, dim=dim2reduce, keepdim=True, unbiased=False) + self.eps).detach()
 
-    def _normalize(self, x):
+    def _affine_params(self, channels):
+        if channels is None:
+            return self.affine_weight, self.affine_bias
+        return self.affine_weight[channels].unsqueeze(1), self.affine_bias[channels].unsqueeze(1)
+
+    def _normalize(self, x, channels=None):
         if self.subtract_last:
             x = x - self.last
         else:
             x = x - self.mean
         x = x / self.stdev
         if self.affine:
-            x = x * self.affine_weight
-            x = x + self.affine_bias
+            affine_weight, affine_bias = self._affine_params(channels)
+            x = x * affine_weight
+            x = x + affine_bias
         return x
 
-    def _denormalize(self, x):
+    def _denormalize(self, x, channels=None):
         if self.affine:
-            x = x - self.affine_bias
-            x = x / (self.affine_weight + self.eps*self.eps)
+            affine_weight, affine_bias = self._affine_params(channels)
+            x = x - affine_bias
+            x = x / (affine_weight + self.eps*self.eps)
         x = x * self.stdev
         if self.subtract_last:
             x = x + self.last
@@ -173,9 +181,9 @@ class Model(nn.Module):
         self.pred_len = configs.pred_len
 
 
-    def forward(self, x, batch_x_mark, dec_inp, batch_y_mark):
-        z = self.rev(x, 'norm') # B, L, D -> B, L, D
+    def forward(self, x, batch_x_mark, dec_inp, batch_y_mark, channels=None):
+        z = self.rev(x, 'norm', channels) # B, L, D -> B, L, D
         z = self.backbone(z) # B, L, D -> B, H, D
-        z = self.rev(z, 'denorm') # B, L, D -> B, H, D
+        z = self.rev(z, 'denorm', channels) # B, L, D -> B, H, D
         return z
 
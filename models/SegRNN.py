@@ -33,7 +33,8 @@ class Model(nn.Module):
         self.dropout = nn.Dropout(configs.dropout)
         self.linear_patch_re = nn.Linear(self.d_model, self.patch_len)
 
-    def forward(self, x, x_mark, y_true, y_mark):
+    def forward(self, x, x_mark, y_true, y_mark, channels=None):
+        # channels: B, C ids of the channels in x when it holds a subset of enc_in, else None
         seq_last = x[:, -1:, :].detach()
         x = x - seq_last
 
@@ -49,9 +50,14 @@ class Model(nn.Module):
 
         enc_out = self.gru(enc_in)[1].repeat(1, 1, M).view(1, -1, self.d_model) # 1, B * C, d -> 1, B * C, M * d -> 1, B * C * M, d
 
+        if channels is None:
+            channel_emb = self.channel_emb.unsqueeze(1).repeat(B, M, 1) # C, d//2 -> C, 1, d//2 -> B * C, M, d//2
+        else:
+            channel_emb = self.channel_emb[channels].reshape(B * C, 1, -1).repeat(1, M, 1) # B, C, d//2 -> B * C, M, d//2
+
         dec_in = torch.cat([
             self.pos_emb.unsqueeze(0).repeat(B*C, 1, 1), # M, d//2 -> 1, M, d//2 -> B * C, M, d//2
-            self.channel_emb.unsqueeze(1).repeat(B, M, 1) # C, d//2 -> C, 1, d//2 -> B * C, M, d//2
+            channel_emb
         ], dim=-1).flatten(0, 1).unsqueeze(1) # B * C, M, d -> B * C * M, d -> B * C * M, 1, d
 
         dec_out = self.gru(dec_in, enc_out)[0]  # B * C * M, 1, d
@@ -0,0 +1,28 @@
+import torch.nn as nn
+
+from models.TSMixer import RevIN, Mixer_Layer
+
+
+class Model(nn.Module):
+    """
+    Compact student for distillation (--distill_from): RevIN, then either a single linear
+    map from the input to the forecast horizon shared by all channels ('linear'), or one
+    TSMixer Mixer_Layer followed by that map ('mixer').
+    """
+
+    def __init__(self, configs):
+        super(Model, self).__init__()
+        self.rev = RevIN(configs.enc_in)
+        self.mix_layer = Mixer_Layer(configs.seq_len, configs.enc_in) if configs.student == 'mixer' else None
+        self.temp_proj = nn.Linear(configs.seq_len, configs.pred_len)
+
+        self.seq_len = configs.seq_len
+        self.pred_len = configs.pred_len
+
+    def forward(self, x, batch_x_mark=None, dec_inp=None, batch_y_mark=None):
+        z = self.rev(x, 'norm') # B, L, D -> B, L, D
+        if self.mix_layer is not None:
+            z = self.mix_layer(z) # B, L, D -> B, L, D
+        z = self.temp_proj(z.permute(0, 2, 1)).permute(0, 2, 1) # B, L, D -> B, D, L -> B, D, H -> B, H, D
+        z = self.rev(z, 'denorm') # B, H, D -> B, H, D
+        return z
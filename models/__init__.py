@@ -0,0 +1,11 @@
+from utils.registry import LazyRegistry
+
+# --model name -> module with a Model(configs) class, imported on first use. Any other
+# module of this package can be selected by its file name, e.g. --model exp_ts.
+model_dict = LazyRegistry({
+    'PatchMixer': 'models.PatchMixer',
+    'SegRNN': 'models.SegRNN',
+    'iTransformer': 'models.iTransformer',
+    'TSMixer': 'models.TSMixer',
+    'Student': 'models.Student',
+}, package='models')
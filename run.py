@@ -1,11 +1,19 @@
 import argparse
 import os
-import torch
-from exp.exp_main import Exp_Main
 import random
-import numpy as np
 
-if __name__ == '__main__':
+
+def int_list(value):
+    """argparse type of comma separated ints, e.g. --pred_lens 96,192."""
+    return [int(v) for v in value.split(',') if v]
+
+
+def str_list(value):
+    """argparse type of comma separated names, e.g. --models TSMixer,PatchMixer."""
+    return [v for v in value.split(',') if v]
+
+
+def build_parser():
     parser = argparse.ArgumentParser(description='Autoformer & Transformer family for Time Series Forecasting')
 
     # random seed
@@ -34,6 +42,9 @@ if __name__ == '__main__':
     parser.add_argument('--seq_len', type=int, default=336, help='input sequence length')
     parser.add_argument('--pred_len', type=int, default=336, help='prediction sequence length')
     parser.add_argument('--enc_in', type=int, default=7, help='channel or dimension')
+    parser.add_argument('--horizons', type=str, default='',
+                        help='comma separated pred_len values, e.g. 96,192,336,720; one model is trained for the longest '
+                             'and evaluated on every horizon by slicing its forecast (overrides --pred_len)')
 
     # model
     parser.add_argument('--patch_len', type=int, default=16, help='patch length')
@@ -67,10 +78,20 @@ if __name__ == '__main__':
     # (just for the convenience of using this code framework, which is commonly used by most researchers in the field.)
     parser.add_argument('--label_len', type=int, default=0, help='unused fot this model')
     parser.add_argument('--output_attention', action='store_true', help='whether to output attention in ecoder')
+    parser.add_argument('--inverse', action='store_true', default=False,
+                        help='report test metrics and save predictions in the original scale of the data')
+    parser.add_argument('--forecast_cache_mb', type=int, default=0,
+                        help='memory budget of the forecast cache used by predict/serving, 0: no cache')
+    parser.add_argument('--forecast_cache_dir', type=str, default='',
+                        help='directory of the on-disk forecast cache tier, empty: memory only')
     parser.add_argument('--do_predict', action='store_true', help='whether to predict unseen future data')
 
     # optimization
     parser.add_argument('--num_workers', type=int, default=10, help='data loader num workers')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='batches loaded in advance by each worker')
+    parser.add_argument('--tune_loader', action='store_true', default=False,
+                        help='time the training loader against the model step before training and pick '
+                             '--num_workers and --prefetch_factor')
     parser.add_argument('--itr', type=int, default=1, help='experiments times')
     parser.add_argument('--train_epochs', type=int, default=10, help='train epochs')
     parser.add_argument('--batch_size', type=int, default=256, help='batch size of train input data')
@@ -79,8 +100,72 @@ if __name__ == '__main__':
     parser.add_argument('--des', type=str, default='test', help='exp description')
     parser.add_argument('--loss', type=str, default='mse', help='loss function')
     parser.add_argument('--lradj', type=str, default='type3', help='adjust learning rate')
+    parser.add_argument('--epoch_samples', type=int, default=0,
+                        help='training windows drawn per epoch, 0: every window')
+    parser.add_argument('--shuffle_block', type=int, default=1,
+                        help='shuffle training windows in contiguous blocks of this many windows, 1: plain shuffle')
+    parser.add_argument('--shuffle_buffer', type=int, default=8,
+                        help='blocks whose windows are shuffled together with --shuffle_block')
+    parser.add_argument('--sample_channels', type=int, default=0,
+                        help='train PatchMixer/SegRNN on random subsets of this many channels per window, '
+                             'evaluate in chunks of as many, 0: all channels')
+    parser.add_argument('--parallel_itr', action='store_true', default=False,
+                        help='train the --itr replicas together in one process instead of one after the other')
+    parser.add_argument('--replica_mode', type=str, default='auto', choices=['auto', 'vmap', 'loop'],
+                        help='how --parallel_itr runs the replicas, auto: the faster of the two on the first batch')
+    parser.add_argument('--eval_every', type=int, default=1,
+                        help='validate every n epochs (and after the last one), early stopping patience counts evaluations')
+    parser.add_argument('--eval_batch_size', type=int, default=0,
+                        help='windows per forward pass in validation, 0: batch_size')
+    parser.add_argument('--eval_stride', type=int, default=1,
+                        help='evaluate val/test on every n-th window only, 1: all windows (final numbers)')
+    parser.add_argument('--eval_samples', type=int, default=0,
+                        help='evaluate val/test on this many seeded random windows and report 95%% CIs, 0: all')
+    parser.add_argument('--async_eval', action='store_true', default=False,
+                        help='validate weight snapshots in a separate process while training continues, '
+                             'early stopping then acts one evaluation late')
+    parser.add_argument('--eval_threads', type=int, default=0,
+                        help='torch threads of the asynchronous evaluation process, 0: torch default')
     parser.add_argument('--pct_start', type=float, default=0.3, help='pct_start')
     parser.add_argument('--use_amp', action='store_true', help='use automatic mixed precision training', default=False)
+    parser.add_argument('--checkpoint_every', type=int, default=1,
+                        help='write the full training state (model, optimizer, scheduler, rng) every n epochs, 0: never')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='continue training from the last full-state checkpoint of the same setting')
+    parser.add_argument('--finetune_from', type=str, default='',
+                        help='checkpoint directory to warm-start from, fine-tunes on newly appended rows instead of training')
+    parser.add_argument('--new_rows', type=int, default=0,
+                        help='rows appended since the checkpoint, 0: all rows after those recorded in its data.json')
+    parser.add_argument('--finetune_epochs', type=int, default=3, help='fine-tuning epochs')
+    parser.add_argument('--replay', type=float, default=0.,
+                        help='old windows replayed per new window while fine-tuning, e.g. 0.5')
+    parser.add_argument('--distill_from', type=str, default='',
+                        help='checkpoint directory of a teacher, trains --model on its forecasts instead of training')
+    parser.add_argument('--teacher_model', type=str, default='PatchMixer',
+                        help='model class of a teacher checkpoint without args.json, others record their own')
+    parser.add_argument('--distill_alpha', type=float, default=0.5,
+                        help='weight of the teacher forecasts in the distillation loss, the rest on the truth')
+    parser.add_argument('--student', type=str, default='mixer', choices=['linear', 'mixer'],
+                        help='Student model: a linear map, or one TSMixer Mixer_Layer and a linear map')
+    parser.add_argument('--results_db', type=str, default='',
+                        help='SQLite file to record runs, epochs and metrics in, e.g. results.db '
+                             '(see utils/results_db.py), empty: no recording')
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='time dataloader wait, host-to-device copy, forward, loss, backward and optimizer step')
+    parser.add_argument('--trace_start', type=int, default=10, help='first global step of the torch.profiler trace')
+    parser.add_argument('--trace_steps', type=int, default=0,
+                        help='steps recorded by torch.profiler into <checkpoints>/<setting>/trace.json, 0: no trace')
+
+    # CPU placement, see utils/placement.py
+    parser.add_argument('--cores', type=str, default='',
+                        help='cpu list to pin the run to, e.g. 0-15,64-79, empty: no pinning')
+    parser.add_argument('--numa_node', type=int, default=-1,
+                        help='pin the run to the cores of this NUMA node (and of --cores, if both are given)')
+    parser.add_argument('--loader_cores', type=str, default='',
+                        help='cpu list for the data loader workers, one core each, empty: the run\'s cores')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='torch intra-op threads, 0: one per pinned core, or torch default when unpinned')
+    parser.add_argument('--interop_threads', type=int, default=0, help='torch inter-op threads, 0: torch default')
 
     # GPU
     parser.add_argument('--use_gpu', type=bool, default=True, help='use gpu')
@@ -88,14 +173,11 @@ if __name__ == '__main__':
     parser.add_argument('--use_multi_gpu', action='store_true', help='use multiple gpus', default=False)
     parser.add_argument('--devices', type=str, default='0,1,2,3', help='device ids of multile gpus')
     parser.add_argument('--test_flop', action='store_true', default=False, help='See utils/tools for usage')
+    return parser
 
-    args = parser.parse_args()
 
-    # random seed
-    fix_seed = args.random_seed
-    random.seed(fix_seed)
-    torch.manual_seed(fix_seed)
-    np.random.seed(fix_seed)
+def finalize_args(args):
+    import torch
 
     args.use_gpu = True if torch.cuda.is_available() and args.use_gpu else False
 
@@ -105,22 +187,93 @@ if __name__ == '__main__':
         args.device_ids = [int(id_) for id_ in device_ids]
         args.gpu = args.device_ids[0]
 
+    if isinstance(args.horizons, str):
+        args.horizons = sorted(int(h) for h in args.horizons.split(',') if h)
+    if args.horizons:
+        args.pred_len = max(args.horizons)
+    return args
+
+
+def get_setting(args, ii):
+    pred_len = '-'.join(str(h) for h in args.horizons) if args.horizons else args.pred_len
+    return '{}_{}_{}_ft{}_sl{}_pl{}_eb{}_{}_{}'.format(args.model_id,
+                                                        args.model,
+                                                        args.data,
+                                                        args.features,
+                                                        args.seq_len,
+                                                        pred_len,
+                                                        args.embed,
+                                                        args.des, ii)
+
+
+if __name__ == '__main__':
+    parser = build_parser()
+    args = finalize_args(parser.parse_args())
+    if args.is_training and args.parallel_itr and not (args.finetune_from or args.distill_from):
+        # Exp_MultiSeed has its own training loop without these
+        unsupported = [flag for flag, value in (('--sample_channels', args.sample_channels), ('--resume', args.resume),
+                                                ('--async_eval', args.async_eval), ('--eval_every', args.eval_every != 1),
+                                                ('--profile', args.profile), ('--trace_steps', args.trace_steps),
+                                                ('--tune_loader', args.tune_loader), ('--use_amp', args.use_amp)) if value]
+        if unsupported:
+            parser.error('--parallel_itr does not support {}'.format(', '.join(unsupported)))
+    if args.distill_from and args.sample_channels:
+        # the teacher forecasts whole windows, channel-sampled items do not pair with them
+        parser.error('--distill_from does not support --sample_channels')
+
+    # torch, the models and the data stack are only imported past argument parsing, --help stays instant
+    import numpy as np
+    import torch
+    from exp.exp_main import Exp_Main
+    from exp.multi_seed import Exp_MultiSeed
+    from utils.placement import configure
+
+    print(configure(args))
+
+    # random seed
+    fix_seed = args.random_seed
+    random.seed(fix_seed)
+    torch.manual_seed(fix_seed)
+    np.random.seed(fix_seed)
+
     print('Args in experiment:')
     print(args)
 
     Exp = Exp_Main
 
-    if args.is_training:
+    if args.finetune_from:
+        setting = get_setting(args, 0)
+
+        exp = Exp(args)  # set experiments
+        print('>>>>>>>fine-tuning : {} from {}>>>>>>>>>>>>>>>>>>>>>>>>>>'.format(setting, args.finetune_from))
+        exp.finetune(setting)
+
+        if args.do_predict:
+            print('>>>>>>>predicting : {}<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'.format(setting))
+            exp.predict(setting, True)
+        torch.cuda.empty_cache()
+    elif args.distill_from:
+        setting = get_setting(args, 0)
+
+        exp = Exp(args)  # set experiments
+        print('>>>>>>>distilling : {} from {}>>>>>>>>>>>>>>>>>>>>>>>>>>'.format(setting, args.distill_from))
+        exp.distill(setting)
+
+        print('>>>>>>>testing : {}<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'.format(setting))
+        exp.test(setting)
+        torch.cuda.empty_cache()
+    elif args.is_training and args.parallel_itr:
+        settings = [get_setting(args, ii) for ii in range(args.itr)]
+
+        exp = Exp_MultiSeed(args)  # set experiments
+        print('>>>>>>>start training {} replicas : {}>>>>>>>>>>>>>>>>>>>>>>>>>>'.format(args.itr, settings[0]))
+        exp.train_replicas(settings)
+        exp.test_replicas(settings)
+        torch.cuda.empty_cache()
+    elif args.is_training:
         for ii in range(args.itr):
             # setting record of experiments
-            setting = '{}_{}_{}_ft{}_sl{}_pl{}_eb{}_{}_{}'.format(args.model_id,
-                                                                  args.model,
-                                                                  args.data,
-                                                                  args.features,
-                                                                  args.seq_len,
-                                                                  args.pred_len,
-                                                                  args.embed,
-                                                                  args.des, ii)
+            setting = get_setting(args, ii)
 
             exp = Exp(args)  # set experiments
             print('>>>>>>>start training : {}>>>>>>>>>>>>>>>>>>>>>>>>>>'.format(setting))
@@ -136,14 +289,7 @@ if __name__ == '__main__':
             torch.cuda.empty_cache()
     else:
         ii = 0
-        setting = '{}_{}_{}_ft{}_sl{}_pl{}_eb{}_{}_{}'.format(args.model_id,
-                                                                                                      args.model,
-                                                                                                      args.data,
-                                                                                                      args.features,
-                                                                                                      args.seq_len,
-                                                                                                      args.pred_len,
-                                                                                                      args.embed,
-                                                                                                      args.des, ii)
+        setting = get_setting(args, ii)
 
         exp = Exp(args)  # set experiments
         print('>>>>>>>testing : {}<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'.format(setting))
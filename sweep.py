@@ -0,0 +1,155 @@
+import argparse
+import itertools
+import multiprocessing as mp
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import torch
+
+from data_provider.data_loader import preload_raw_data
+from exp.exp_main import Exp_Main
+from run import build_parser, finalize_args, get_setting, int_list, str_list
+from utils.placement import pin
+
+# core set of the current pool worker, filled in by _init_worker
+_worker_cores = None
+
+
+def _init_worker(core_queue):
+    global _worker_cores
+    _worker_cores, threads = core_queue.get()
+    pin(_worker_cores, threads)
+
+
+def _run_one(run_args, ii):
+    args = argparse.Namespace(**run_args)
+
+    # a pool worker starts afresh for every row, the replicas of a config would all get
+    # the same draws; run.py seeds once and its --itr replicas diverge, here replica ii
+    # is seeded with random_seed + ii
+    fix_seed = args.random_seed + ii
+    random.seed(fix_seed)
+    torch.manual_seed(fix_seed)
+    np.random.seed(fix_seed)
+
+    setting = get_setting(args, ii)
+    print('>>>>>>>start training : {} on cores {}>>>>>>>>>>>>>>>>>>>>>>>>>>'.format(setting, _worker_cores))
+    start = time.time()
+    exp = Exp_Main(args)
+    exp.train(setting)
+    train_time = time.time() - start
+
+    print('>>>>>>>testing : {}<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'.format(setting))
+    mae, mse, rmse, mape, mspe, rse, corr = exp.test(setting)
+    return {
+        'setting': setting,
+        'model': args.model,
+        'seq_len': args.seq_len,
+        'pred_len': args.pred_len,
+        'itr': ii,
+        'mse': float(mse),
+        'mae': float(mae),
+        'rse': float(rse),
+        'train_time': train_time,
+        'error': '',
+    }
+
+
+def build_grid(args, sweep_args):
+    # with --horizons a single run already covers every pred_len
+    pred_lens = sweep_args.pred_lens if sweep_args.pred_lens and not args.horizons else [args.pred_len]
+    grid = []
+    for model, seq_len, pred_len in itertools.product(sweep_args.models or [args.model],
+                                                      sweep_args.seq_lens or [args.seq_len],
+                                                      pred_lens):
+        run_args = dict(vars(args), model=model, seq_len=seq_len, pred_len=pred_len)
+        for ii in range(args.itr):
+            grid.append((run_args, ii))
+    return grid
+
+
+def split_cores(n_parallel, cores_per_run):
+    """
+    (cores, threads) of every pool worker, the cores taken in order from those this
+    process may use. Workers left without a full core set run unpinned, with an even
+    share of the cores as their torch thread count instead of torch's default of all
+    cores, so they do not oversubscribe the machine.
+    """
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+    if not cores_per_run:
+        cores_per_run = len(available) // n_parallel
+    shared_threads = max(1, (len(available) or os.cpu_count() or 1) // n_parallel)
+    placements = []
+    for slot in range(n_parallel):
+        cores = available[slot * cores_per_run:(slot + 1) * cores_per_run]
+        if cores_per_run and len(cores) == cores_per_run:
+            placements.append((cores, 0))
+        else:
+            placements.append(([], shared_threads))
+    return placements
+
+
+def write_table(results, path):
+    columns = ['setting', 'model', 'seq_len', 'pred_len', 'itr', 'mse', 'mae', 'rse', 'train_time', 'error']
+    table = pd.DataFrame(results, columns=columns).sort_values(['model', 'seq_len', 'pred_len', 'itr'])
+    table.to_csv(path, index=False)
+    return table
+
+
+if __name__ == '__main__':
+    sweep_parser = argparse.ArgumentParser(description='Run a grid of run.py settings on a process pool',
+                                           epilog='all other arguments are passed on to run.py')
+    sweep_parser.add_argument('--models', type=str_list, default=None, help='comma separated models, default --model')
+    sweep_parser.add_argument('--seq_lens', type=int_list, default=None, help='comma separated seq_len values')
+    sweep_parser.add_argument('--pred_lens', type=int_list, default=None, help='comma separated pred_len values')
+    sweep_parser.add_argument('--n_parallel', type=int, default=1, help='number of runs in flight')
+    sweep_parser.add_argument('--cores_per_run', type=int, default=0,
+                              help='cores pinned to each run, 0: split the available cores evenly')
+    sweep_parser.add_argument('--sweep_out', type=str, default='sweep_results.csv', help='result table')
+    sweep_args, rest = sweep_parser.parse_known_args()
+
+    args = finalize_args(build_parser().parse_args(rest))
+    if args.use_gpu:
+        # forked workers cannot re-initialise cuda
+        mp_context = mp.get_context('spawn')
+    else:
+        mp_context = mp.get_context('fork')
+        # parse the csv once, forked workers share the frame
+        preload_raw_data(args.root_path, args.data_path)
+
+    grid = build_grid(args, sweep_args)
+    print('Sweep of {} runs, {} in parallel'.format(len(grid), sweep_args.n_parallel))
+
+    core_queue = mp_context.Queue()
+    for placement in split_cores(sweep_args.n_parallel, sweep_args.cores_per_run):
+        core_queue.put(placement)
+
+    results = []
+    failed = 0
+    with ProcessPoolExecutor(max_workers=sweep_args.n_parallel, mp_context=mp_context,
+                             initializer=_init_worker, initargs=(core_queue,)) as pool:
+        futures = {pool.submit(_run_one, run_args, ii): (run_args, ii) for run_args, ii in grid}
+        for future in as_completed(futures):
+            run_args, ii = futures[future]
+            try:
+                row = future.result()
+            except Exception as e:
+                # a failed run gets its row and the error, the rest of the sweep goes on
+                failed += 1
+                setting = get_setting(argparse.Namespace(**run_args), ii)
+                print('>>>>>>>failed : {}: {!r}'.format(setting, e))
+                row = {'setting': setting, 'model': run_args['model'], 'seq_len': run_args['seq_len'],
+                       'pred_len': run_args['pred_len'], 'itr': ii, 'error': repr(e)}
+            results.append(row)
+            # rewritten as results arrive, an interrupted sweep keeps the finished runs
+            write_table(results, sweep_args.sweep_out)
+
+    table = write_table(results, sweep_args.sweep_out)
+    print(table.to_string(index=False))
+    if failed:
+        raise SystemExit('{} of {} runs failed, see the error column of {}'.format(
+            failed, len(grid), sweep_args.sweep_out))
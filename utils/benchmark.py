@@ -0,0 +1,224 @@
+"""
+Model throughput benchmark on synthetic inputs.
+
+    python -m utils.benchmark --models PatchMixer,SegRNN --seq_lens 336,720 --out bench.json
+    python -m utils.benchmark --out new.json --compare bench.json
+
+Arguments not listed below are passed on to the run.py parser, e.g. --patch_len 48.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import torch.nn.functional as F
+
+from exp.exp_main import model_dict
+from run import build_parser, int_list, str_list
+from utils.timefeatures import time_features_from_frequency_str
+
+METRICS = ['fwd_ms', 'fwd_bwd_ms', 'infer_ms', 'peak_mem_mb']
+
+
+def _rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class PeakRSS:
+    """
+    Peak resident memory inside a `with` block, sampled from a background thread.
+
+    `peak` is the highest RSS seen and `delta` its growth over the RSS at entry, both in bytes.
+    Without /proc the process-wide ru_maxrss is reported instead and `delta` stays 0.
+    """
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.peak = 0
+        self.delta = 0
+        self._stop = threading.Event()
+
+    def _poll(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _rss_bytes())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self._proc = os.path.exists('/proc/self/statm')
+        if self._proc:
+            self.start = self.peak = _rss_bytes()
+            self._thread = threading.Thread(target=self._poll, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._proc:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, _rss_bytes())
+            self.delta = self.peak - self.start
+        else:
+            # ru_maxrss is in bytes on macOS, in KiB elsewhere
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak = rss if sys.platform == 'darwin' else rss * 1024
+        return False
+
+
+def make_configs(overrides=None, argv=None):
+    args = build_parser().parse_args(argv or [])
+    args.use_gpu = False
+    args.horizons = []
+    for k, v in (overrides or {}).items():
+        setattr(args, k, v)
+    return args
+
+
+def make_inputs(args, batch_size):
+    mark_dim = len(time_features_from_frequency_str(args.freq))
+    dec_len = args.label_len + args.pred_len
+    return (torch.randn(batch_size, args.seq_len, args.enc_in),
+            torch.randn(batch_size, args.seq_len, mark_dim),
+            torch.zeros(batch_size, dec_len, args.enc_in),
+            torch.randn(batch_size, dec_len, mark_dim))
+
+
+def time_call(fn, warmup=3, repeat=10):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def bench_case(args, batch_size, warmup=3, repeat=10):
+    model = model_dict[args.model].Model(args).float()
+    inputs = make_inputs(args, batch_size)
+    target = torch.randn(batch_size, args.pred_len, args.enc_in)
+
+    def forward():
+        return model(*inputs)
+
+    def forward_backward():
+        model.zero_grad(set_to_none=True)
+        F.mse_loss(model(*inputs)[:, -args.pred_len:], target).backward()
+
+    def inference():
+        with torch.inference_mode():
+            model(*inputs)
+
+    result = {'params': sum(p.numel() for p in model.parameters())}
+    with PeakRSS() as mem:
+        model.train()
+        result['fwd_ms'] = time_call(forward, warmup, repeat)
+        result['fwd_bwd_ms'] = time_call(forward_backward, warmup, repeat)
+        model.eval()
+        result['infer_ms'] = time_call(inference, warmup, repeat)
+    result['peak_mem_mb'] = mem.delta / 2 ** 20
+    return result
+
+
+def bench_case_isolated(args, batch_size, warmup=3, repeat=10):
+    """
+    bench_case in a freshly forked process: memory freed by an earlier case stays in
+    this process' heap and would hide the next case's peak.
+    """
+    if 'fork' not in mp.get_all_start_methods():
+        return bench_case(args, batch_size, warmup, repeat)
+    with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('fork')) as pool:
+        return pool.submit(bench_case, args, batch_size, warmup, repeat).result()
+
+
+def run_benchmark(bench_args, run_argv):
+    results = []
+    for model, batch_size, seq_len, pred_len, enc_in in itertools.product(
+            bench_args.models, bench_args.batch_sizes, bench_args.seq_lens,
+            bench_args.pred_lens, bench_args.enc_ins):
+        case = {'model': model, 'batch_size': batch_size, 'seq_len': seq_len,
+                'pred_len': pred_len, 'enc_in': enc_in}
+        args = make_configs(dict(case, dec_in=enc_in, c_out=enc_in), run_argv)
+        try:
+            case.update(bench_case_isolated(args, batch_size, bench_args.warmup, bench_args.repeat))
+        except Exception as e:
+            # some models constrain the shapes, e.g. SegRNN needs seq_len % patch_len == 0
+            case['error'] = '{}: {}'.format(type(e).__name__, e)
+        print(case)
+        results.append(case)
+    return {
+        'meta': {
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'threads': torch.get_num_threads(),
+            'argv': run_argv,
+        },
+        'results': results,
+    }
+
+
+def _case_key(case):
+    return case['model'], case['batch_size'], case['seq_len'], case['pred_len'], case['enc_in']
+
+
+def compare(current, baseline, tolerance):
+    """Cases whose metric grew by more than `tolerance` (relative) over the baseline."""
+    base = {_case_key(c): c for c in baseline['results'] if 'error' not in c}
+    regressions = []
+    for case in current['results']:
+        old = base.get(_case_key(case))
+        if old is None or 'error' in case:
+            continue
+        for name in METRICS:
+            # memory deltas near zero are sampling noise, give them 1MB of slack
+            slack = 1.0 if name == 'peak_mem_mb' else 0.0
+            if case[name] > old[name] * (1 + tolerance) + slack:
+                regressions.append((_case_key(case), name, old[name], case[name]))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Forward/backward/inference latency and peak memory on CPU',
+                                     epilog='all other arguments are passed on to run.py')
+    parser.add_argument('--models', type=str_list, default=list(model_dict), help='comma separated models')
+    parser.add_argument('--batch_sizes', type=int_list, default=[32, 256])
+    parser.add_argument('--seq_lens', type=int_list, default=[336])
+    parser.add_argument('--pred_lens', type=int_list, default=[96])
+    parser.add_argument('--enc_ins', type=int_list, default=[7, 321])
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads, 0: torch default')
+    parser.add_argument('--out', type=str, default='benchmark.json')
+    parser.add_argument('--compare', type=str, default='', help='baseline json to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown')
+    bench_args, run_argv = parser.parse_known_args()
+
+    if bench_args.threads:
+        torch.set_num_threads(bench_args.threads)
+    torch.manual_seed(0)
+
+    report = run_benchmark(bench_args, run_argv)
+    with open(bench_args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results written to {}'.format(bench_args.out))
+
+    if bench_args.compare:
+        with open(bench_args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, bench_args.tolerance)
+        for key, name, old, new in regressions:
+            print('REGRESSION {} {}: {:.3f} -> {:.3f}'.format(key, name, old, new))
+        if regressions:
+            sys.exit(1)
+        print('no regressions against {}'.format(bench_args.compare))
@@ -0,0 +1,168 @@
+"""
+Analytic MAC/FLOP and parameter counter, CPU only.
+
+    python -m utils.flops --models PatchMixer,SegRNN --batch_size 1 --seq_len 336 --pred_len 96
+
+Forward hooks count the multiply-accumulates of Linear, Conv1d, GRU, the norm layers
+and iTransformer's attention from their shapes while the model's real
+forward(x, x_mark, dec_inp, y_mark) runs. Element-wise work outside those modules
+(RevIN, residual adds, activations) is not counted. FLOPs are reported as 2 * MACs.
+The CLI adds inference latency to give an efficiency report per model.
+"""
+import argparse
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+from exp.exp_main import model_dict
+from utils.benchmark import make_configs, make_inputs, time_call
+
+
+def _linear_macs(module, inputs, output):
+    return output.numel() * module.in_features
+
+
+def _conv1d_macs(module, inputs, output):
+    return output.numel() * (module.in_channels // module.groups) * module.kernel_size[0]
+
+
+def _gru_macs(module, inputs, output):
+    x = inputs[0]
+    batch, steps = (x.shape[0], x.shape[1]) if module.batch_first else (x.shape[1], x.shape[0])
+    if x.dim() == 2:  # unbatched input
+        batch, steps = 1, x.shape[0]
+    directions = 2 if module.bidirectional else 1
+    macs = 0
+    input_size = module.input_size
+    for _ in range(module.num_layers):
+        # reset, update and new gates, each with an input and a hidden projection
+        macs += 3 * (input_size + module.hidden_size) * module.hidden_size * directions
+        input_size = module.hidden_size * directions
+    return macs * batch * steps
+
+
+def _norm_macs(module, inputs, output):
+    # normalize then scale and shift, about one multiply-accumulate per element
+    return inputs[0].numel()
+
+
+def _full_attention_macs(module, inputs, output):
+    queries, keys, values = inputs[:3]
+    B, L, H, E = queries.shape
+    S = keys.shape[1]
+    D = values.shape[-1]
+    # scores = q @ k^T and out = A @ v
+    return B * H * L * S * (E + D)
+
+
+MAC_HANDLERS = {
+    nn.Linear: _linear_macs,
+    nn.Conv1d: _conv1d_macs,
+    nn.GRU: _gru_macs,
+    nn.BatchNorm1d: _norm_macs,
+    nn.LayerNorm: _norm_macs,
+}
+
+# modules defined inside models/, matched by class name to keep this file free of model imports
+NAMED_MAC_HANDLERS = {
+    'FullAttention': _full_attention_macs,
+}
+
+
+def _handler(module):
+    for cls, handler in MAC_HANDLERS.items():
+        if isinstance(module, cls):
+            return handler
+    return NAMED_MAC_HANDLERS.get(type(module).__name__)
+
+
+def count_model(model, inputs):
+    """
+    Run model(*inputs) once under no_grad and count.
+
+    Returns (total_macs, total_params, stats) where stats maps every module name to
+    the MACs and parameters of its whole subtree.
+    """
+    names = {module: name or '<model>' for name, module in model.named_modules()}
+    self_macs = OrderedDict((name, 0) for name in names.values())
+    handles = []
+
+    def make_hook(name, handler):
+        def hook(module, hook_inputs, output):
+            self_macs[name] += int(handler(module, hook_inputs, output))
+        return hook
+
+    for module, name in names.items():
+        handler = _handler(module)
+        if handler is not None:
+            handles.append(module.register_forward_hook(make_hook(name, handler)))
+
+    was_training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            model(*inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.train(was_training)
+
+    stats = OrderedDict()
+    for name, module in model.named_modules():
+        name = name or '<model>'
+        prefix = '' if name == '<model>' else name + '.'
+        macs = sum(m for n, m in self_macs.items() if n == name or (not prefix or n.startswith(prefix)))
+        stats[name] = {'macs': macs, 'params': sum(p.numel() for p in module.parameters())}
+    return stats['<model>']['macs'], stats['<model>']['params'], stats
+
+
+def format_counts(stats, max_depth=2):
+    lines = ['{:<50} {:>14} {:>12}'.format('module', 'MMACs', 'params')]
+    for name, s in stats.items():
+        depth = 0 if name == '<model>' else name.count('.') + 1
+        if depth > max_depth or (not s['macs'] and not s['params']):
+            continue
+        lines.append('{:<50} {:>14.3f} {:>12,}'.format('  ' * depth + name.split('.')[-1],
+                                                       s['macs'] / 1e6, s['params']))
+    return '\n'.join(lines)
+
+
+def efficiency_report(models, batch_size, run_argv, repeat=10):
+    rows = []
+    for model_name in models:
+        args = make_configs({'model': model_name}, run_argv)
+        model = model_dict[model_name].Model(args).float().eval()
+        inputs = make_inputs(args, batch_size)
+        macs, params, _ = count_model(model, inputs)
+
+        def inference():
+            with torch.inference_mode():
+                model(*inputs)
+
+        latency_ms = time_call(inference, repeat=repeat)
+        rows.append({'model': model_name, 'params': params, 'gflops': 2 * macs / 1e9, 'latency_ms': latency_ms,
+                     'gflops_per_s': 2 * macs / 1e9 / (latency_ms / 1000)})
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Analytic FLOPs, parameters and FLOPs/latency efficiency per model',
+                                     epilog='all other arguments are passed on to run.py')
+    parser.add_argument('--models', type=lambda v: [m for m in v.split(',') if m], default=list(model_dict))
+    parser.add_argument('--depth', type=int, default=2, help='module depth of the per-module breakdown')
+    parser.add_argument('--repeat', type=int, default=10)
+    flop_args, run_argv = parser.parse_known_args()
+    batch_size = make_configs(argv=run_argv).batch_size
+
+    for model_name in flop_args.models:
+        args = make_configs({'model': model_name}, run_argv)
+        model = model_dict[model_name].Model(args).float()
+        _, _, stats = count_model(model, make_inputs(args, batch_size))
+        print(model_name)
+        print(format_counts(stats, flop_args.depth))
+        print()
+
+    print('{:<14} {:>12} {:>10} {:>12} {:>10}'.format('model', 'params', 'GFLOPs', 'latency ms', 'GFLOP/s'))
+    for row in efficiency_report(flop_args.models, batch_size, run_argv, flop_args.repeat):
+        print('{model:<14} {params:>12,} {gflops:>10.3f} {latency_ms:>12.2f} {gflops_per_s:>10.2f}'.format(**row))
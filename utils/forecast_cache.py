@@ -0,0 +1,106 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+def model_identity(model):
+    """Digest of a model's parameters and buffers, forecasts are only reused for the exact same weights."""
+    h = hashlib.blake2b(digest_size=16)
+    for name, tensor in model.state_dict().items():
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+class ForecastCache:
+    """
+    Forecasts of single input windows, keyed by a hash of the (scaled) model inputs of the
+    window, the model identity and pred_len.
+
+    The memory tier is an LRU bounded by max_bytes of cached forecasts. With disk_dir set
+    every forecast is also written there (atomically) and a memory miss falls back to
+    it, so the cache outlives the process and can be shared between processes.
+    hits / disk_hits / misses count windows.
+    """
+
+    def __init__(self, max_bytes=256 * 2 ** 20, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def key(model_id, pred_len, *arrays):
+        h = hashlib.blake2b(digest_size=20)
+        h.update('{}:{}'.format(model_id, pred_len).encode())
+        for a in arrays:
+            a = np.ascontiguousarray(a)
+            h.update(str(a.shape).encode())
+            h.update(a.tobytes())
+        return h.hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + '.npy')
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        if self.disk_dir and os.path.exists(self._disk_path(key)):
+            value = np.load(self._disk_path(key))
+            self._remember(key, value)
+            self.disk_hits += 1
+            return value
+        self.misses += 1
+        return None
+
+    def _remember(self, key, value):
+        if value.nbytes > self.max_bytes:
+            return
+        self.entries[key] = value
+        self.nbytes += value.nbytes
+        while self.nbytes > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, value)
+            os.replace(tmp_path, path)
+
+    def forecast(self, model_id, pred_len, inputs, forward):
+        """
+        Batched lookup: inputs is a tuple of [B, ...] tensors, forward(*inputs) the model
+        call. Only the windows missing from the cache are run through forward, in one batch.
+        """
+        arrays = [t.detach().cpu().numpy() for t in inputs]
+        keys = [self.key(model_id, pred_len, *(a[i] for a in arrays)) for i in range(len(arrays[0]))]
+        cached = [self.get(k) for k in keys]
+        missing = [i for i, value in enumerate(cached) if value is None]
+        if missing:
+            index = torch.as_tensor(missing, device=inputs[0].device)
+            outputs = forward(*(t.index_select(0, index) for t in inputs)).detach().cpu().numpy()
+            for i, value in zip(missing, outputs):
+                value = np.ascontiguousarray(value)
+                self.put(keys[i], value)
+                cached[i] = value
+        return torch.from_numpy(np.stack(cached)).to(inputs[0].device)
+
+    def report(self):
+        total = self.hits + self.disk_hits + self.misses
+        return 'forecast cache: {} hits, {} from disk, {} misses ({:.0%} hit rate), {:.1f} MB in memory'.format(
+            self.hits, self.disk_hits, self.misses, (self.hits + self.disk_hits) / max(total, 1), self.nbytes / 2 ** 20)
@@ -0,0 +1,156 @@
+"""
+Per-module memory report for one training step of a model on a synthetic batch.
+
+    python -m utils.memory --model PatchMixer --batch_size 256 --seq_len 720 --pred_len 96 --enc_in 321
+
+For every submodule it lists the bytes of its outputs, of the tensors autograd saves
+for backward while it runs, and of its own parameters and gradients; the step's peak
+RSS (and the cuda allocator peak on --device cuda) is reported at the end.
+"""
+import argparse
+import json
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+
+from exp.exp_main import model_dict
+from utils.benchmark import PeakRSS, make_configs, make_inputs
+
+
+def _tensor_bytes(obj):
+    if torch.is_tensor(obj):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, (list, tuple)):
+        return sum(_tensor_bytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(_tensor_bytes(o) for o in obj.values())
+    return 0
+
+
+class ModuleMemoryRecorder:
+    """
+    Hooks every submodule of `model`. While active, output bytes and saved-for-backward
+    bytes are charged to the innermost module that is running.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.stats = OrderedDict((name or '<model>', {'calls': 0, 'output': 0, 'saved': 0, 'params': 0, 'grads': 0})
+                                 for name, _ in model.named_modules())
+        self._stack = []
+        self._seen = set()
+        self._handles = []
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            self._stack.append(name)
+        return hook
+
+    def _post_hook(self, name):
+        def hook(module, inputs, output):
+            self._stack.pop()
+            self.stats[name]['calls'] += 1
+            self.stats[name]['output'] += _tensor_bytes(output)
+        return hook
+
+    def _pack(self, tensor):
+        # ops often save views of one storage (e.g. a reshape of the previous output),
+        # the whole storage stays alive, so it is charged once, to the first module saving it;
+        # storages of the parameters are in _seen from the start, they count under 'params'
+        storage = tensor.untyped_storage()
+        if self._stack and storage.data_ptr() not in self._seen:
+            self._seen.add(storage.data_ptr())
+            self.stats[self._stack[-1]]['saved'] += storage.nbytes()
+        return tensor
+
+    def __enter__(self):
+        self._seen.update(p.untyped_storage().data_ptr() for p in self.model.parameters())
+        for name, module in self.model.named_modules():
+            name = name or '<model>'
+            self._handles.append(module.register_forward_pre_hook(self._pre_hook(name)))
+            self._handles.append(module.register_forward_hook(self._post_hook(name)))
+        self._saved_hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, lambda t: t)
+        self._saved_hooks.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self._saved_hooks.__exit__(*exc)
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        return False
+
+    def collect_params(self):
+        for name, module in self.model.named_modules():
+            name = name or '<model>'
+            for p in module.parameters(recurse=False):
+                self.stats[name]['params'] += p.numel() * p.element_size()
+                if p.grad is not None:
+                    self.stats[name]['grads'] += p.grad.numel() * p.grad.element_size()
+
+
+def memory_report(args, batch_size, device='cpu'):
+    device = torch.device(device)
+    model = model_dict[args.model].Model(args).float().to(device)
+    model.train()
+    inputs = [t.to(device) for t in make_inputs(args, batch_size)]
+    target = torch.randn(batch_size, args.pred_len, args.enc_in, device=device)
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    with PeakRSS() as mem:
+        with ModuleMemoryRecorder(model) as recorder:
+            outputs = model(*inputs)
+        F.mse_loss(outputs[:, -args.pred_len:], target).backward()
+    recorder.collect_params()
+
+    report = {
+        'model': args.model,
+        'batch_size': batch_size,
+        'seq_len': args.seq_len,
+        'pred_len': args.pred_len,
+        'enc_in': args.enc_in,
+        'peak_rss_mb': mem.peak / 2 ** 20,
+        'step_rss_mb': mem.delta / 2 ** 20,
+        'modules': recorder.stats,
+    }
+    if device.type == 'cuda':
+        report['cuda_peak_allocated_mb'] = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return report
+
+
+def format_report(report, top=20):
+    mb = 2 ** 20
+    lines = ['{} batch {} seq_len {} pred_len {} enc_in {}'.format(
+        report['model'], report['batch_size'], report['seq_len'], report['pred_len'], report['enc_in'])]
+    lines.append('{:<45} {:>5} {:>11} {:>11} {:>10} {:>10}'.format(
+        'module', 'calls', 'output MB', 'saved MB', 'param MB', 'grad MB'))
+    modules = sorted(report['modules'].items(), key=lambda kv: kv[1]['saved'] + kv[1]['output'], reverse=True)
+    for name, s in modules[:top]:
+        lines.append('{:<45} {:>5} {:>11.2f} {:>11.2f} {:>10.2f} {:>10.2f}'.format(
+            name, s['calls'], s['output'] / mb, s['saved'] / mb, s['params'] / mb, s['grads'] / mb))
+    totals = {k: sum(s[k] for s in report['modules'].values()) for k in ('saved', 'params', 'grads')}
+    lines.append('saved for backward {:.2f} MB, params {:.2f} MB, grads {:.2f} MB'.format(
+        totals['saved'] / mb, totals['params'] / mb, totals['grads'] / mb))
+    lines.append('peak RSS {:.1f} MB (+{:.1f} MB during the step)'.format(report['peak_rss_mb'], report['step_rss_mb']))
+    if 'cuda_peak_allocated_mb' in report:
+        lines.append('cuda allocator peak {:.1f} MB'.format(report['cuda_peak_allocated_mb']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-module activation, parameter and gradient memory',
+                                     epilog='all other arguments are passed on to run.py, e.g. --model, --seq_len')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--top', type=int, default=20, help='modules listed, largest first')
+    parser.add_argument('--out', type=str, default='', help='also write the full report as json')
+    mem_args, run_argv = parser.parse_known_args()
+
+    args = make_configs(argv=run_argv)
+    args.dec_in = args.c_out = args.enc_in
+    report = memory_report(args, args.batch_size, mem_args.device)
+    print(format_report(report, mem_args.top))
+    if mem_args.out:
+        with open(mem_args.out, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -1,5 +1,8 @@
 import numpy as np
 
+# names of the scores metric() returns, in its order
+METRIC_NAMES = ['mae', 'mse', 'rmse', 'mape', 'mspe', 'rse', 'corr']
+
 
 def RSE(pred, true):
     return np.sqrt(np.sum((true - pred) ** 2)) / np.sqrt(np.sum((true - true.mean()) ** 2))
@@ -42,3 +45,38 @@ def metric(pred, true):
     corr = CORR(pred, true)
 
     return mae, mse, rmse, mape, mspe, rse, corr
+
+
+def metric_per_window(pred, true):
+    """
+    metric() of every window on its own, [N, L, D] arrays in, the seven scores as [N]
+    arrays out, without a loop over the windows. CORR correlates across windows, over a
+    single window metric() gives 0 for it, and so does this.
+    """
+    axes = tuple(range(1, pred.ndim))
+    err = pred - true
+    mae = np.mean(np.abs(err), axis=axes)
+    mse = np.mean(err ** 2, axis=axes)
+    rmse = np.sqrt(mse)
+    mape = np.mean(np.abs(err / true), axis=axes)
+    mspe = np.mean(np.square(err / true), axis=axes)
+    rse = np.sqrt(np.sum(err ** 2, axis=axes)) / np.sqrt(
+        np.sum((true - true.mean(axis=axes, keepdims=True)) ** 2, axis=axes))
+    corr = np.zeros(len(pred))
+    return mae, mse, rmse, mape, mspe, rse, corr
+
+
+def mean_ci(values, population=None, z=1.96):
+    """
+    Mean of per-window values and the half width of its normal-approximation confidence
+    interval (z=1.96: 95%). When the windows are a sample drawn without replacement from
+    `population` windows the finite population correction is applied.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    if n < 2:
+        return values.mean(), np.nan
+    se = values.std(ddof=1) / np.sqrt(n)
+    if population and population > 1:
+        se *= np.sqrt(max(population - n, 0) / (population - 1))
+    return values.mean(), z * se
@@ -0,0 +1,125 @@
+"""
+CPU placement of a run: the cores of the main process and of its data loader workers,
+and torch's intra-/inter-op thread counts (run.py --cores / --numa_node / --loader_cores /
+--threads / --interop_threads).
+
+Memory is not bound explicitly: Linux allocates pages on the node of the core that first
+touches them, so a process pinned to one node's cores keeps its tensors on that node.
+Child processes (loader workers, the async evaluator) inherit the affinity of the main
+process unless they are pinned on their own.
+"""
+import functools
+import glob
+import os
+import re
+
+
+def parse_cpulist(text):
+    """'0-3,8,10-11' (the format of taskset and /sys cpulist files) -> [0, 1, 2, 3, 8, 10, 11]."""
+    cores = []
+    for part in text.replace(' ', '').split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cores.extend(range(int(first), int(last or first) + 1))
+    return sorted(set(cores))
+
+
+def format_cpulist(cores):
+    """Inverse of parse_cpulist, consecutive cores collapsed into ranges."""
+    ranges = []
+    for core in sorted(cores):
+        if ranges and core == ranges[-1][1] + 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ','.join(str(a) if a == b else '{}-{}'.format(a, b) for a, b in ranges)
+
+
+def numa_nodes():
+    """{node: cores} from /sys, empty where the kernel does not expose NUMA topology."""
+    nodes = {}
+    for path in glob.glob('/sys/devices/system/node/node*/cpulist'):
+        with open(path) as f:
+            nodes[int(re.search(r'node(\d+)', path).group(1))] = parse_cpulist(f.read().strip())
+    return dict(sorted(nodes.items()))
+
+
+def available_cores():
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+
+
+def resolve_cores(cores='', numa_node=-1):
+    """
+    The cores a cpu list and/or NUMA node select, restricted to those this process may run
+    on; [] when nothing is selected (no pinning).
+    """
+    selected = set(parse_cpulist(cores)) if cores else None
+    if numa_node >= 0:
+        nodes = numa_nodes()
+        if numa_node not in nodes:
+            raise ValueError('NUMA node {} not found, nodes: {}'.format(numa_node, list(nodes) or 'none exposed'))
+        node_cores = set(nodes[numa_node])
+        selected = node_cores if selected is None else selected & node_cores
+    if selected is None:
+        return []
+    usable = sorted(selected & set(available_cores()))
+    if not usable:
+        raise ValueError('none of the requested cores {} is available to this process ({})'.format(
+            format_cpulist(selected), format_cpulist(available_cores())))
+    return usable
+
+
+def pin(cores, threads=0):
+    """Pin this process to cores and give torch one intra-op thread per core (or `threads`)."""
+    import torch
+    if cores:
+        os.sched_setaffinity(0, cores)
+    if threads or cores:
+        torch.set_num_threads(threads or len(cores))
+
+
+def pin_loader_worker(cores, worker_id):
+    """worker_init_fn of data loader workers: worker i runs on cores[i % len(cores)] with one thread."""
+    import torch
+    os.sched_setaffinity(0, [cores[worker_id % len(cores)]])
+    torch.set_num_threads(1)
+
+
+def loader_worker_init(args):
+    """worker_init_fn pinning the loader workers to --loader_cores, None to inherit the main process' cores."""
+    cores = getattr(args, 'loader_cores_resolved', None)
+    return functools.partial(pin_loader_worker, cores) if cores else None
+
+
+def configure(args):
+    """
+    Apply the placement arguments to this process, before any torch work runs (inter-op
+    threads can only be set once, up front). The resolved loader cores are kept in
+    args.loader_cores_resolved for the data loaders. Returns the report line.
+    """
+    import torch
+    cores = resolve_cores(args.cores, args.numa_node)
+    pin(cores, args.threads)
+    if args.interop_threads:
+        torch.set_num_interop_threads(args.interop_threads)
+    args.loader_cores_resolved = resolve_cores(args.loader_cores) if args.loader_cores else []
+    if cores and not args.loader_cores_resolved and torch.get_num_threads() + args.num_workers > len(cores):
+        print('warning: {} torch threads and {} loader workers share {} cores, consider --loader_cores '
+              'or fewer --num_workers'.format(torch.get_num_threads(), args.num_workers, len(cores)))
+    return report(args)
+
+
+def report(args=None):
+    """Effective placement of this process, as the kernel and torch see it."""
+    import torch
+    cores = available_cores()
+    nodes = sorted(node for node, node_cores in numa_nodes().items() if set(node_cores) & set(cores))
+    line = 'placement: cores {} ({}), NUMA node(s) {}, torch threads {} intra-op / {} inter-op'.format(
+        format_cpulist(cores), len(cores), ','.join(map(str, nodes)) or '-',
+        torch.get_num_threads(), torch.get_num_interop_threads())
+    loader_cores = getattr(args, 'loader_cores_resolved', None)
+    if args is not None and args.num_workers:
+        line += ', {} loader workers on {}'.format(
+            args.num_workers, format_cpulist(loader_cores) if loader_cores else 'the same cores')
+    return line
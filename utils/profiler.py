@@ -0,0 +1,120 @@
+import time
+from contextlib import nullcontext
+
+import torch
+
+STAGES = ['data', 'h2d', 'forward', 'loss', 'backward', 'step']
+
+
+class _Stage:
+    __slots__ = ('timer', 'name', 'start', 'record')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        # shows up as a labelled range when a torch.profiler trace is recording
+        self.record = torch.profiler.record_function(self.name)
+        self.record.__enter__()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.timer.sync:
+            torch.cuda.synchronize()
+        self.timer.totals[self.name] += time.perf_counter() - self.start
+        self.record.__exit__(*exc)
+        return False
+
+
+class StageTimer:
+    """
+    Wall time per training stage (dataloader wait, host-to-device copy, forward, loss,
+    backward, optimizer step). On cuda every stage synchronizes on exit, so kernels are
+    charged to the stage that launched them.
+    """
+
+    def __init__(self, device):
+        self.sync = device.type == 'cuda'
+        self.reset()
+
+    def reset(self):
+        self.totals = dict.fromkeys(STAGES, 0.0)
+        self.steps = 0
+        self.samples = 0
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def iter(self, iterable, name='data'):
+        it = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def step(self, n_samples):
+        self.steps += 1
+        self.samples += n_samples
+
+    def report(self):
+        """Per-stage ms/iter and share of the measured time since the last report, then reset."""
+        total = sum(self.totals.values())
+        if not self.steps or not total:
+            return ''
+        parts = ['{} {:.2f}ms ({:.0%})'.format(name, t / self.steps * 1000, t / total)
+                 for name, t in self.totals.items()]
+        line = '\tstages/iter: ' + ', '.join(parts) + '; {:.1f} samples/s'.format(self.samples / total)
+        self.reset()
+        return line
+
+
+class NullTimer:
+    """Drop-in for StageTimer when profiling is off, every call is a no-op."""
+
+    _null = nullcontext()
+
+    def stage(self, name):
+        return self._null
+
+    def iter(self, iterable, name='data'):
+        return iterable
+
+    def step(self, n_samples):
+        pass
+
+    def report(self):
+        return ''
+
+
+class TraceWindow:
+    """Records `steps` iterations starting at global step `start` with torch.profiler, exported as a Chrome trace."""
+
+    def __init__(self, start, steps, trace_path, device):
+        self.start = start
+        self.stop = start + steps
+        self.trace_path = trace_path
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+        self.recording = False
+
+    def step(self, global_step):
+        if global_step == self.start:
+            self.profiler.start()
+            self.recording = True
+        elif global_step == self.stop:
+            self.close()
+
+    def close(self):
+        """Ends the window early if training stops inside it."""
+        if self.recording:
+            self.profiler.stop()
+            self.profiler.export_chrome_trace(self.trace_path)
+            print('torch.profiler trace of steps {}-{} written to {}'.format(self.start, self.stop - 1,
+                                                                             self.trace_path))
+            self.recording = False
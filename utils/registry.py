@@ -0,0 +1,52 @@
+import importlib
+from collections.abc import Mapping
+
+
+class LazyRegistry(Mapping):
+    """
+    Name -> object mapping whose objects are imported on first lookup.
+
+    `entries` maps a name to 'module' or 'module:attribute'. Names not listed fall back
+    to the module `<package>.<name>` when `package` is set, so a new file in the package
+    is usable by its file name without registering it. Iteration and len() only cover
+    the listed names and import nothing.
+    """
+
+    def __init__(self, entries, package=None):
+        self.entries = dict(entries)
+        self.package = package
+        self._loaded = {}
+
+    def _resolve(self, name):
+        if name in self.entries:
+            target = self.entries[name]
+        elif self.package and name.isidentifier():
+            target = '{}.{}'.format(self.package, name)
+        else:
+            raise KeyError(name)
+        module_name, _, attribute = target.partition(':')
+        try:
+            module = importlib.import_module(module_name)
+        except ModuleNotFoundError as e:
+            if name in self.entries or e.name != module_name:
+                raise
+            raise KeyError(name) from None
+        return getattr(module, attribute) if attribute else module
+
+    def __getitem__(self, name):
+        if name not in self._loaded:
+            self._loaded[name] = self._resolve(name)
+        return self._loaded[name]
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,211 @@
+"""
+SQLite store of experiment results, one row per run plus one per epoch.
+
+    python -m utils.results_db                                  # latest runs
+    python -m utils.results_db --model PatchMixer --sort mse --last 50
+    python -m utils.results_db --group_by model,seq_len,pred_len
+    python -m utils.results_db --epochs 12                      # epoch log of run 12
+
+Exp_Main.train/test write to the file given with run.py --results_db, nothing is
+recorded without it. Every write is one short transaction on a WAL-mode database with a busy
+timeout, so concurrent runs (sweep workers, several shells) can share the file.
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    setting TEXT NOT NULL,
+    model TEXT,
+    data TEXT,
+    seq_len INTEGER,
+    pred_len INTEGER,
+    args TEXT,
+    host TEXT,
+    pid INTEGER,
+    started REAL,
+    finished REAL,
+    params INTEGER,
+    train_time REAL,
+    epochs INTEGER,
+    peak_mem_mb REAL,
+    mae REAL, mse REAL, rmse REAL, mape REAL, mspe REAL, rse REAL, corr REAL
+);
+CREATE TABLE IF NOT EXISTS epochs (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    epoch INTEGER NOT NULL,
+    train_loss REAL,
+    vali_loss REAL,
+    test_loss REAL,
+    epoch_time REAL,
+    samples_per_s REAL,
+    PRIMARY KEY (run_id, epoch)
+);
+CREATE INDEX IF NOT EXISTS runs_setting ON runs(setting);
+"""
+
+
+def _plain(value):
+    # numpy scalars and other non-JSON values of args
+    if hasattr(value, 'item'):
+        return value.item()
+    return value if isinstance(value, (int, float, str, bool, list, type(None))) else str(value)
+
+
+class ResultsStore:
+    """
+    Writer and reader of a results database. A connection is opened per call, which keeps
+    the store safe to use from forked or spawned processes and never holds a lock
+    between writes.
+    """
+
+    def __init__(self, path, timeout=60.):
+        self.path = path
+        self.timeout = timeout
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        try:
+            # readers no longer block the writer, nor the writer the readers
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self, write=True):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return _Transaction(conn, write)
+
+    def start_run(self, setting, args):
+        """New run row for setting with all of args, returns its id."""
+        values = {k: _plain(v) for k, v in sorted(vars(args).items())}
+        with self._connect() as conn:
+            cur = conn.execute(
+                'INSERT INTO runs (setting, model, data, seq_len, pred_len, args, host, pid, started) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (setting, values.get('model'), values.get('data'), values.get('seq_len'), values.get('pred_len'),
+                 json.dumps(values), socket.gethostname(), os.getpid(), time.time()))
+            return cur.lastrowid
+
+    def log_epoch(self, run_id, epoch, **values):
+        """Insert or complete the row of an epoch; columns left out (or None) keep what is stored."""
+        columns = ['train_loss', 'vali_loss', 'test_loss', 'epoch_time', 'samples_per_s']
+        unknown = set(values) - set(columns)
+        if unknown:
+            raise ValueError('unknown epoch columns: {}'.format(', '.join(sorted(unknown))))
+        row = [_plain(values.get(c)) for c in columns]
+        updates = ', '.join('{0} = COALESCE(excluded.{0}, {0})'.format(c) for c in columns)
+        with self._connect() as conn:
+            conn.execute('INSERT INTO epochs (run_id, epoch, {}) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                         'ON CONFLICT (run_id, epoch) DO UPDATE SET {}'.format(', '.join(columns), updates),
+                         [run_id, epoch] + row)
+
+    def update_run(self, run_id, **values):
+        """Set columns of a run, e.g. params, train_time, epochs, peak_mem_mb or the metrics."""
+        if not values:
+            return
+        names = list(values)
+        with self._connect() as conn:
+            conn.execute('UPDATE runs SET {}, finished = ? WHERE id = ?'.format(
+                ', '.join('{} = ?'.format(n) for n in names)), [_plain(values[n]) for n in names] + [time.time(), run_id])
+
+    def runs(self, where='', params=(), order='id DESC', limit=None):
+        """Runs with the mean epoch time and throughput of their epochs, as a list of dicts."""
+        sql = ('SELECT runs.*, AVG(epochs.epoch_time) AS epoch_time, AVG(epochs.samples_per_s) AS samples_per_s, '
+               'MIN(epochs.vali_loss) AS best_vali FROM runs LEFT JOIN epochs ON epochs.run_id = runs.id '
+               '{} GROUP BY runs.id ORDER BY {}'.format('WHERE ' + where if where else '', order))
+        if limit:
+            sql += ' LIMIT {:d}'.format(limit)
+        with self._connect(write=False) as conn:
+            return [dict(row) for row in conn.execute(sql, params)]
+
+    def epochs(self, run_id):
+        with self._connect(write=False) as conn:
+            return [dict(row) for row in conn.execute('SELECT * FROM epochs WHERE run_id = ? ORDER BY epoch',
+                                                      (run_id,))]
+
+
+class _Transaction:
+    """`with` block of one transaction on a connection, committed or rolled back and closed on exit."""
+
+    def __init__(self, conn, write=True):
+        self.conn = conn
+        self.write = write
+
+    def __enter__(self):
+        # writers take the lock up front, waiting up to the busy timeout for other writers,
+        # instead of failing when a read transaction turns into a write
+        self.conn.execute('BEGIN IMMEDIATE' if self.write else 'BEGIN')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        finally:
+            self.conn.close()
+
+
+def peak_memory_mb(device=None):
+    """Peak cuda allocation on a cuda device, else the peak RSS of this process."""
+    import torch
+    if device is not None and device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    import resource
+    # ru_maxrss is in bytes on macOS, in KiB elsewhere
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 1024
+
+
+if __name__ == '__main__':
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description='Query the results database')
+    parser.add_argument('--db', type=str, default='results.db')
+    parser.add_argument('--model', type=str, default='', help='only runs of this model')
+    parser.add_argument('--data', type=str, default='', help='only runs on this dataset')
+    parser.add_argument('--setting', type=str, default='', help='only settings containing this text')
+    parser.add_argument('--sort', type=str, default='id', help='column to sort by, e.g. mse, train_time, params')
+    parser.add_argument('--last', type=int, default=20, help='number of runs to show, 0: all')
+    parser.add_argument('--group_by', type=str, default='',
+                        help='comma separated columns, show mean and count of the matching runs per group')
+    parser.add_argument('--epochs', type=int, default=0, help='show the epoch log of this run id')
+    q_args = parser.parse_args()
+
+    if not os.path.exists(q_args.db):
+        raise SystemExit('no results database at {}'.format(q_args.db))
+    store = ResultsStore(q_args.db)
+    pd.set_option('display.width', 200)
+    pd.set_option('display.max_columns', 30)
+    if q_args.epochs:
+        print(pd.DataFrame(store.epochs(q_args.epochs)).drop(columns='run_id').to_string(index=False))
+        raise SystemExit
+
+    conditions, params = [], []
+    for column in ('model', 'data'):
+        if getattr(q_args, column):
+            conditions.append('runs.{} = ?'.format(column))
+            params.append(getattr(q_args, column))
+    if q_args.setting:
+        conditions.append('runs.setting LIKE ?')
+        params.append('%{}%'.format(q_args.setting))
+    runs = pd.DataFrame(store.runs(' AND '.join(conditions), params))
+    if runs.empty:
+        raise SystemExit('no matching runs')
+
+    columns = ['params', 'train_time', 'epoch_time', 'samples_per_s', 'peak_mem_mb', 'best_vali', 'mse', 'mae']
+    if q_args.group_by:
+        keys = [k for k in q_args.group_by.split(',') if k]
+        table = runs.groupby(keys)[columns].mean()
+        table.insert(0, 'runs', runs.groupby(keys).size())
+        table = table.sort_values(q_args.sort if q_args.sort in table.columns else 'mse')
+    else:
+        ascending = q_args.sort != 'id'
+        table = runs.sort_values(q_args.sort, ascending=ascending)[['id', 'setting'] + columns]
+        if q_args.last:
+            table = table.head(q_args.last)
+    print(table.to_string(index=bool(q_args.group_by), float_format=lambda v: '{:.4g}'.format(v)))
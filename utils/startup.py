@@ -0,0 +1,87 @@
+"""
+CLI startup time, each case measured in fresh interpreters.
+
+    python -m utils.startup --out startup.json
+    python -m utils.startup --compare startup_old.json
+
+Cases: `run.py --help`, importing exp.exp_main (what every sweep worker, backtest and
+benchmark pays before its first step) and that plus building the default model. The
+import time of exp.exp_main is broken down by package from `python -X importtime`.
+This module itself only uses the standard library, so it does not skew what it measures.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = {
+    'help': ['run.py', '--help'],
+    'import_exp': ['-c', 'import exp.exp_main'],
+    'build_model': ['-c', 'from run import build_parser, finalize_args\n'
+                          'from exp.exp_main import model_dict\n'
+                          'args = finalize_args(build_parser().parse_args([]))\n'
+                          'model_dict[args.model].Model(args)'],
+}
+
+
+def _env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in [ROOT, env.get('PYTHONPATH', '')] if p)
+    return env
+
+
+def time_case(argv, repeat=5):
+    """Median wall time in ms of `python argv` over repeat runs, after one warm-up run for the file cache."""
+    times = []
+    for i in range(repeat + 1):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + argv, cwd=ROOT, env=_env(), check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if i:
+            times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def top_imports(statement='import exp.exp_main', top=8):
+    """(top-level package, ms) of the packages whose modules take longest to import in statement."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=ROOT, env=_env(),
+                            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    packages = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[0].split(':')[-1].strip().isdigit():
+            continue
+        package = parts[2].strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(parts[0].split(':')[-1]) / 1000
+    return sorted(packages.items(), key=lambda item: -item[1])[:top]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Startup time of the CLI and of importing the experiment code')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--out', type=str, default='startup.json')
+    parser.add_argument('--compare', type=str, default='', help='earlier --out json to compare with')
+    st_args = parser.parse_args()
+
+    report = {name: time_case(argv, st_args.repeat) for name, argv in CASES.items()}
+    baseline = {}
+    if st_args.compare:
+        with open(st_args.compare) as f:
+            baseline = json.load(f)
+    for name, ms in report.items():
+        line = '{:<12}{:>9.1f} ms'.format(name, ms)
+        if name in baseline:
+            line += '  (was {:.1f} ms, {:.2f}x)'.format(baseline[name], baseline[name] / ms)
+        print(line)
+    print('import time of exp.exp_main by package:')
+    for name, ms in top_imports():
+        print('  {:<28}{:>9.1f} ms'.format(name, ms))
+    with open(st_args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results written to {}'.format(st_args.out))
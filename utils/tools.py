@@ -1,10 +1,12 @@
+import os
+import queue
+import random
+import threading
+
 import numpy as np
 import torch
-import matplotlib.pyplot as plt
 import time
 
-plt.switch_backend('agg')
-
 
 def adjust_learning_rate(optimizer, scheduler, epoch, args, printout=True):
     # lr = args.learning_rate * (0.2 ** (epoch // 2))
@@ -38,14 +40,15 @@ def adjust_learning_rate(optimizer, scheduler, epoch, args, printout=True):
 
 
 class EarlyStopping:
-    def __init__(self, patience=7, verbose=False, delta=0):
+    def __init__(self, patience=7, verbose=False, delta=0, writer=None):
         self.patience = patience
         self.verbose = verbose
         self.counter = 0
         self.best_score = None
         self.early_stop = False
-        self.val_loss_min = np.Inf
+        self.val_loss_min = np.inf
         self.delta = delta
+        self.writer = writer
 
     def __call__(self, val_loss, model, path):
         score = -val_loss
@@ -65,9 +68,101 @@ class EarlyStopping:
     def save_checkpoint(self, val_loss, model, path):
         if self.verbose:
             print(f'Validation loss decreased ({self.val_loss_min:.6f} --> {val_loss:.6f}).  Saving model ...')
-        torch.save(model.state_dict(), path + '/' + 'checkpoint.pth')
+        # model can also be a state dict, e.g. a snapshot evaluated after training moved on
+        state_dict = model if isinstance(model, dict) else model.state_dict()
+        if self.writer is not None:
+            self.writer.save(state_dict, path + '/' + 'checkpoint.pth')
+        else:
+            torch.save(state_dict, path + '/' + 'checkpoint.pth')
         self.val_loss_min = val_loss
 
+    def state_dict(self):
+        return {'counter': self.counter, 'best_score': self.best_score,
+                'early_stop': self.early_stop, 'val_loss_min': self.val_loss_min}
+
+    def load_state_dict(self, state):
+        self.counter = state['counter']
+        self.best_score = state['best_score']
+        self.early_stop = state['early_stop']
+        self.val_loss_min = state['val_loss_min']
+
+
+def cpu_snapshot(obj):
+    """Copy of obj with every tensor (also inside dicts, lists and tuples) detached and copied to CPU."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: cpu_snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return obj
+
+
+class CheckpointWriter:
+    """
+    Saves checkpoints from a background thread.
+
+    save() snapshots every tensor to CPU before returning, so training can go on
+    mutating the model while the file is written. Files are written to a temporary
+    name and renamed, a reader never sees a half-written checkpoint.
+    """
+
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, obj, path):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((cpu_snapshot(obj), path))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            obj, path = item
+            try:
+                tmp_path = path + '.tmp'
+                torch.save(obj, tmp_path)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
 
 class dotdict(dict):
     """dot.notation access to dictionary attributes"""
@@ -77,15 +172,77 @@ class dotdict(dict):
 
 
 class StandardScaler():
-    def __init__(self, mean, std):
-        self.mean = mean
-        self.std = std
+    """
+    Per-channel standardization over the last axis, a drop-in for sklearn's StandardScaler.
+
+    fit() accumulates count, mean and sum of squared deviations chunk by chunk in float64,
+    merging the chunks with Chan et al.'s parallel update, so a large training border never
+    has to be materialized in float64 at once; partial_fit() adds more rows later on.
+    transform() / inverse_transform() take numpy arrays or tensors, tensors are handled on
+    their own device and dtype. state_dict() holds everything needed to restore the fit.
+    """
+
+    def __init__(self, mean=None, std=None):
+        self.n = 0
+        self.mean = None if mean is None else torch.as_tensor(mean, dtype=torch.float64)
+        self.std = None if std is None else torch.as_tensor(std, dtype=torch.float64)
+        self.m2 = None
+        self._cache = {}
+
+    def fit(self, data, chunk_size=65536):
+        self.n = 0
+        self.mean = self.std = self.m2 = None
+        for start in range(0, len(data), chunk_size):
+            self.partial_fit(data[start:start + chunk_size])
+        return self
+
+    def partial_fit(self, data):
+        x = torch.as_tensor(np.asarray(data, dtype=np.float64))
+        x = x.reshape(-1, x.shape[-1])
+        n_b = x.shape[0]
+        if n_b == 0:
+            return self
+        mean_b = x.mean(0)
+        m2_b = ((x - mean_b) ** 2).sum(0)
+        if self.n == 0:
+            self.mean, self.m2 = mean_b, m2_b
+        else:
+            n = self.n + n_b
+            delta = mean_b - self.mean
+            self.mean = self.mean + delta * n_b / n
+            self.m2 = self.m2 + m2_b + delta ** 2 * self.n * n_b / n
+        self.n += n_b
+        std = torch.sqrt(self.m2 / self.n)
+        # like sklearn, constant channels are left unscaled
+        self.std = torch.where(std < 10 * np.finfo(np.float64).eps, torch.ones_like(std), std)
+        self._cache = {}
+        return self
+
+    def _stats_like(self, data):
+        if torch.is_tensor(data):
+            key = (data.device, data.dtype)
+            if key not in self._cache:
+                self._cache[key] = (self.mean.to(data.device, data.dtype), self.std.to(data.device, data.dtype))
+            return self._cache[key]
+        return self.mean.numpy(), self.std.numpy()
 
     def transform(self, data):
-        return (data - self.mean) / self.std
+        mean, std = self._stats_like(data)
+        return (data - mean) / std
 
     def inverse_transform(self, data):
-        return (data * self.std) + self.mean
+        mean, std = self._stats_like(data)
+        return (data * std) + mean
+
+    def state_dict(self):
+        return {'n': self.n, 'mean': self.mean, 'std': self.std, 'm2': self.m2}
+
+    def load_state_dict(self, state):
+        self.n = state['n']
+        self.mean = state['mean']
+        self.std = state['std']
+        self.m2 = state['m2']
+        self._cache = {}
 
 
 def visual(true, preds=None, name='./pic/test.pdf', data_name=None, seq_len=None, pred_len=None):
@@ -100,6 +257,11 @@ def visual(true, preds=None, name='./pic/test.pdf', data_name=None, seq_len=None
     - seq_len: Length of the sequence.
     - pred_len: Length of the predictions.
     """
+    # imported here, matplotlib costs about half a second of startup for every run that never plots
+    import matplotlib
+    matplotlib.use('agg')
+    import matplotlib.pyplot as plt
+
     plt.figure()
     plt.plot(true, label='GroundTruth', linewidth=2)
     if preds is not None:
@@ -117,18 +279,14 @@ def visual(true, preds=None, name='./pic/test.pdf', data_name=None, seq_len=None
     plt.close()
     
     
-def test_params_flop(model,x_shape):
+def test_params_flop(model, inputs):
     """
-    If you want to thest former's flop, you need to give default value to inputs in model.forward(), the following code can only pass one argument to forward()
+    Parameter count and analytic MACs of one forward pass, see utils/flops.py.
+    inputs are the four forward() arguments (x, x_mark, dec_inp, y_mark); counting runs on CPU.
     """
-    model_params = 0
-    for parameter in model.parameters():
-        model_params += parameter.numel()
-        print('INFO: Trainable parameter count: {:.2f}M'.format(model_params / 1000000.0))
-    from ptflops import get_model_complexity_info    
-    with torch.cuda.device(0):
-        macs, params = get_model_complexity_info(model.cuda(), x_shape, as_strings=True, print_per_layer_stat=True)
-        # print('Flops:' + flops)
-        # print('Params:' + params)
-        print('{:<30}  {:<8}'.format('Computational complexity: ', macs))
-        print('{:<30}  {:<8}'.format('Number of parameters: ', params))
\ No newline at end of file
+    from utils.flops import count_model, format_counts
+    model = model.cpu()
+    macs, params, stats = count_model(model, [t.cpu() for t in inputs])
+    print(format_counts(stats))
+    print('{:<30}  {:<8}'.format('Computational complexity: ', '{:.3f} GMac'.format(macs / 1e9)))
+    print('{:<30}  {:<8}'.format('Number of parameters: ', '{:.2f}M'.format(params / 1e6)))